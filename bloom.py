@@ -0,0 +1,48 @@
+# bloom filters over event ids
+# a filter answers "maybe held" or "surely not held": there are no false negatives, and with
+# BITS_PER_KEY bits per id and HASHES hash functions about 1% of the ids that are not held still
+# come back as maybe. The peers build one over the ids each member holds and share them, see
+# bloom_filters in peer.py
+#
+# the k bit positions of a key come from one blake2b digest by double hashing (h1 + i * h2)
+
+import base64
+import hashlib
+
+BITS_PER_KEY = 10
+HASHES = 7
+MIN_BITS = 64
+
+class BloomFilter:
+    def __init__(self, bits, hashes=HASHES, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    def positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        return [(first + i * second) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def encode(self):
+        # for a JSON message
+        return {'bits': self.bits, 'hashes': self.hashes, 'data': base64.b64encode(bytes(self.data)).decode()}
+
+def decode(encoded):
+    return BloomFilter(encoded['bits'], encoded['hashes'], base64.b64decode(encoded['data']))
+
+def build(keys):
+    # a filter sized for the given keys
+    keys = list(keys)
+    bloom = BloomFilter(max(MIN_BITS, BITS_PER_KEY * len(keys)))
+    for key in keys:
+        bloom.add(key)
+    return bloom
@@ -0,0 +1,229 @@
+# binary cache of the storm event datasets
+# populate_dht used to reparse ./CSVFiles/details-<year>.csv with csv.reader on every setup-dht,
+# join-dht and leave-dht. The first time a year is used it is converted once into
+# ./CSVFiles/cache/details-<year>.cache, which holds the records together with the row count,
+# the table size (first prime after 2 * rows) and each record's position (event id mod table size).
+# Later setups of the same year load that instead, with no CSV parsing and no per row hashing.
+#
+# records are kept as the raw CSV lines. Placing a record only needs its event id, the first field,
+# so the conversion memory maps the CSV and reads each line up to its first comma instead of running
+# csv.reader over all the fields. The lines travel as they are in store messages and the owner splits
+# a record into its fields the first time it is looked up (parse_line)
+#
+# a cache can also be pre-partitioned for ring sizes: for each ring size the row numbers are stored
+# grouped by owning member (position mod ring size), so populate_dht can send each member's records
+# without looking at the event ids at all
+#
+# for parallel setups plan_ranges splits the data rows into line aligned byte ranges, one per ring
+# member, and every member reads its own range with scan_range
+#
+# one time conversion:
+#   python dataset_cache.py 1950 --ring-size 3 --ring-size 5
+#
+# file layout: HEADER (magic, format version, source size, source mtime, rows, table size) followed
+# by a marshal blob {'records', 'positions', 'partitions'}. The cache is stale, and ignored, when the
+# CSV's size or mtime don't match the header or the version has changed
+
+import os
+import csv
+import mmap
+import struct
+import marshal
+import argparse
+
+CACHE_MAGIC = b'DHTC'
+CACHE_VERSION = 2
+HEADER = struct.Struct('!4sHQqII')
+CSV_DIRECTORY = './CSVFiles'
+CACHE_DIRECTORY = './CSVFiles/cache'
+
+def csv_path(year):
+    return os.path.join(CSV_DIRECTORY, f"details-{year}.csv")
+
+def cache_path(year):
+    return os.path.join(CACHE_DIRECTORY, f"details-{year}.cache")
+
+def is_prime(n):
+    if n < 2:
+        return False
+    i = 2
+    while i * i <= n:
+        if n % i == 0:
+            return False
+        i += 1
+    return True
+
+def next_prime_after(n):
+    n = n + 1
+    while not is_prime(n):
+        n = n + 1
+    return n
+
+class Dataset:
+# one year of records, parsed and placed
+    def __init__(self, year, records, table_size, positions, partitions=None):
+        self.year = year
+        self.records = records          # raw CSV lines, one per row (header row dropped)
+        self.table_size = table_size
+        self.positions = positions      # int(event id) % table_size, per row
+        self.partitions = partitions or {}  # ring size: list (one per member) of row numbers
+
+    def partition(self, ring_size):
+        # row numbers grouped by owning member, computed now if the cache doesn't have them
+        rows = self.partitions.get(ring_size)
+        if rows is None:
+            rows = [[] for _ in range(ring_size)]
+            for row, position in enumerate(self.positions):
+                rows[position % ring_size].append(row)
+            self.partitions[ring_size] = rows
+        return rows
+
+def line_event_id(line):
+    # the event id of a raw line, the first field is always a plain number
+    return int(line[:line.index(',')].strip('"'))
+
+def parse_line(line):
+    # the fields of a raw line, as csv.reader would give them
+    return tuple(next(csv.reader([line])))
+
+def data_start(data):
+    # offset of the first data row, just past the header row
+    start = data.find(b'\n') + 1
+    return start if start > 0 else len(data)
+
+def records_in(data, start, end):
+    # (start, stop) of every record in data[start:end], start must be a record boundary
+    while start < end:
+        stop = data.find(b'\n', start, end)
+        stop = stop if stop >= 0 else end
+        # a quoted field can hold a newline, keep going until the quotes balance
+        while data[start:stop].count(b'"') % 2 and stop < end:
+            stop = data.find(b'\n', stop + 1, end)
+            stop = stop if stop >= 0 else end
+        yield start, stop
+        start = stop + 1
+
+def scan_lines(data, start, end):
+    # the records in data[start:end] as raw lines, with their event ids read straight from the bytes
+    lines = []
+    event_ids = []
+    for record_start, record_stop in records_in(data, start, end):
+        line = data[record_start:record_stop].rstrip(b'\r')
+        if not line:
+            continue
+        event_ids.append(int(line[:line.index(b',')].strip(b'"')))
+        lines.append(line.decode())
+    return lines, event_ids
+
+def mapped(year):
+    # the year's CSV memory mapped, None for an empty file. Use as a context manager
+    with open(csv_path(year), 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def scan_csv(year):
+    data = mapped(year)
+    if data is None:
+        lines, event_ids = [], []
+    else:
+        with data:
+            lines, event_ids = scan_lines(data, data_start(data), len(data))
+    table_size = next_prime_after(2 * len(lines))
+    positions = [event_id % table_size for event_id in event_ids]
+    return Dataset(year, lines, table_size, positions)
+
+def scan_range(year, start, end):
+    # (lines, event ids) of the records in one range handed out by plan_ranges
+    data = mapped(year)
+    if data is None:
+        return [], []
+    with data:
+        return scan_lines(data, start, end)
+
+def plan_ranges(year, parts):
+    # splits the data rows into parts byte ranges of about the same size that start and end on
+    # record boundaries. Returns (rows, ranges), ranges may be empty for tiny files.
+    # Only walks the record boundaries, nothing is decoded
+    data = mapped(year)
+    if data is None:
+        return 0, [(0, 0)] * parts
+    with data:
+        first = data_start(data)
+        end = len(data)
+        step = max(1, (end - first) // parts)
+        boundaries = [first]
+        rows = 0
+        for record_start, record_stop in records_in(data, first, end):
+            if record_start >= boundaries[-1] + step and len(boundaries) < parts:
+                boundaries.append(record_start)
+            if record_stop > record_start:
+                rows += 1
+    boundaries += [end] * (parts + 1 - len(boundaries))
+    return rows, [(boundaries[i], boundaries[i + 1]) for i in range(parts)]
+
+def source_stamp(year):
+    stat = os.stat(csv_path(year))
+    return stat.st_size, stat.st_mtime_ns
+
+def write(dataset, ring_sizes=()):
+    # atomically (re)writes the cache for dataset.year, with partitions for the given ring sizes
+    for ring_size in ring_sizes:
+        dataset.partition(ring_size)
+    size, mtime = source_stamp(dataset.year)
+    blob = marshal.dumps({'records': dataset.records,
+                          'positions': dataset.positions,
+                          'partitions': dataset.partitions})
+    path = cache_path(dataset.year)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(HEADER.pack(CACHE_MAGIC, CACHE_VERSION, size, mtime, len(dataset.records), dataset.table_size))
+        file.write(blob)
+    os.replace(tmp_path, path)
+
+def load(year):
+    # the cached dataset, or None if there is no cache or it doesn't match the CSV any more
+    try:
+        size, mtime = source_stamp(year)
+        with open(cache_path(year), 'rb') as file:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            magic, version, cached_size, cached_mtime, rows, table_size = HEADER.unpack(header)
+            if magic != CACHE_MAGIC or version != CACHE_VERSION or (cached_size, cached_mtime) != (size, mtime):
+                return None
+            data = marshal.loads(file.read())
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+    if len(data['records']) != rows:
+        return None
+    return Dataset(year, data['records'], table_size, data['positions'], data['partitions'])
+
+def get(year, ring_size=None):
+    # what populate_dht uses: the cache if fresh, otherwise parse the CSV and write the cache
+    # for next time. A cache that can't be written (read only directory) is not an error
+    dataset = load(year)
+    if dataset is not None:
+        return dataset
+    dataset = scan_csv(year)
+    try:
+        write(dataset, [ring_size] if ring_size else ())
+    except OSError as e:
+        print(f"Could not write dataset cache for {year}: {e}")
+    return dataset
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a storm events CSV into the binary dataset cache')
+    parser.add_argument('years', type=int, nargs='+')
+    parser.add_argument('--ring-size', type=int, action='append', default=[],
+                        help='also store the partition for this ring size (can be repeated)')
+    args = parser.parse_args()
+    for year in args.years:
+        dataset = scan_csv(year)
+        write(dataset, args.ring_size)
+        print(f"{cache_path(year)}: {len(dataset.records)} rows, table size {dataset.table_size}, "
+              f"partitions {sorted(dataset.partitions)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# framing for peer to peer messages
+# every peer message is a small fixed routing header followed by an opaque payload
+# (the JSON encoded message), so a node that only forwards a message can read where it
+# is going from the header and pass the original buffer on without decoding the payload
+#
+# header, network byte order:
+#   magic   B   FRAME_MAGIC, tells frames apart from plain JSON datagrams (which start with '{')
+#   type    B   message type code, see TYPE_CODES
+#   target  h   ring identifier of the node the message is for, -1 if it is for whoever receives it
+#   ttl     H   hops left before a forwarder drops the message, wide enough for a walk around
+#               any ring the target field can address
+#   flags   B   FLAG_FRAGMENT if this datagram is one piece of a larger frame,
+#               FLAG_TRACE if the message belongs to a trace (see tracing.py)
+#   length  I   payload length in bytes (of this piece, for fragments)
+#
+# traced frames carry the trace id right after the header:
+#   trace   Q   trace id, so forwarders can record a hop without decoding the payload
+#
+# fragments carry another header after those:
+#   msg_id  I   picked by the sender, the same for every piece of one frame
+#   index   H   position of this piece
+#   count   H   number of pieces
+# type and target are copied onto every piece, so forwarders route fragments one by one
+# and only the destination reassembles them. Plain JSON datagrams that are too big (to and
+# from the manager) are wrapped in a 'message' frame and fragmented the same way
+
+import struct
+import json
+import time
+import random
+import itertools
+import threading
+from collections import OrderedDict
+
+FRAME_MAGIC = 0xD7
+HEADER = struct.Struct('!BBhHBI')
+HEADER_SIZE = HEADER.size
+TTL = struct.Struct('!H')
+TTL_OFFSET = 4
+FLAGS_OFFSET = 6
+DEFAULT_TTL = 0xFFFF
+NO_TARGET = -1
+
+FLAG_FRAGMENT = 0x01
+FLAG_TRACE = 0x02
+FRAGMENT_HEADER = struct.Struct('!IHH')
+TRACE_HEADER = struct.Struct('!Q')
+
+MAX_DATAGRAM = 8192             #largest datagram we send, bigger messages are fragmented
+RECV_BUFFER_SIZE = 65535        #largest datagram we accept
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+REASSEMBLY_TIMEOUT = 5.0        #seconds a partly received message is kept
+REASSEMBLY_MAX_BYTES = 64 * 1024 * 1024   #total bytes held for partly received messages
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024      #SO_RCVBUF to ask for, so bursts of fragments aren't dropped
+
+message_ids = itertools.count(random.getrandbits(31))
+
+# command-type of the message: type code. Anything not listed travels as 'message'
+TYPE_CODES = {
+    'message': 0,
+    'store': 1,
+    'store-batch': 2,
+    'store-replica': 3,
+    'find-event': 4,
+    'teardown': 5,
+    'reset-id': 6,
+}
+TYPE_NAMES = {code: type_name for type_name, code in TYPE_CODES.items()}
+
+# types that travel hop by hop around the ring towards their target
+ROUTED_TYPES = (TYPE_CODES['store'], TYPE_CODES['store-batch'])
+
+def encode(message, target=NO_TARGET, ttl=DEFAULT_TTL, trace_id=None):
+    payload = json.dumps(message).encode()
+    type_code = TYPE_CODES.get(message.get('command-type'), TYPE_CODES['message'])
+    if trace_id is None:
+        return HEADER.pack(FRAME_MAGIC, type_code, target, ttl, 0, len(payload)) + payload
+    return HEADER.pack(FRAME_MAGIC, type_code, target, ttl, FLAG_TRACE, len(payload)) + TRACE_HEADER.pack(trace_id) + payload
+
+def is_frame(buf):
+    return len(buf) >= HEADER_SIZE and buf[0] == FRAME_MAGIC
+
+def read_header(buf):
+    # returns (type_code, target, ttl, flags, length) without touching the payload
+    _, type_code, target, ttl, flags, length = HEADER.unpack_from(buf)
+    return type_code, target, ttl, flags, length
+
+def decrement_ttl(buf):
+    # in place on a writable buffer (bytearray or a memoryview of one), returns the new ttl
+    (ttl,) = TTL.unpack_from(buf, TTL_OFFSET)
+    ttl = max(ttl - 1, 0)
+    TTL.pack_into(buf, TTL_OFFSET, ttl)
+    return ttl
+
+def is_fragment(buf):
+    return is_frame(buf) and buf[FLAGS_OFFSET] & FLAG_FRAGMENT
+
+def trace_id(buf):
+    # the trace id of a traced frame, None for anything else. A frame cut short before its
+    # trace id has none, it fails to decode further on
+    if is_frame(buf) and buf[FLAGS_OFFSET] & FLAG_TRACE and len(buf) >= HEADER_SIZE + TRACE_HEADER.size:
+        return TRACE_HEADER.unpack_from(buf, HEADER_SIZE)[0]
+    return None
+
+def fragment_offset(buf):
+    return HEADER_SIZE + (TRACE_HEADER.size if buf[FLAGS_OFFSET] & FLAG_TRACE else 0)
+
+def payload_offset(buf):
+    return fragment_offset(buf) + (FRAGMENT_HEADER.size if buf[FLAGS_OFFSET] & FLAG_FRAGMENT else 0)
+
+def split(datagram, max_size=MAX_DATAGRAM):
+    # the datagrams to send for one message: itself if it fits, fragments otherwise
+    if len(datagram) <= max_size:
+        return [datagram]
+    if is_frame(datagram):
+        type_code, target, ttl, _, length = read_header(datagram)
+        offset = payload_offset(datagram)
+        payload = memoryview(datagram)[offset:offset + length]
+    else:
+        type_code, target, ttl, payload = TYPE_CODES['message'], NO_TARGET, DEFAULT_TTL, memoryview(datagram)
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise ValueError(f"message of {len(payload)} bytes is larger than {MAX_MESSAGE_SIZE}")
+    trace = trace_id(datagram)
+    flags = FLAG_FRAGMENT if trace is None else FLAG_FRAGMENT | FLAG_TRACE
+    trace_header = b'' if trace is None else TRACE_HEADER.pack(trace)
+    chunk_size = max_size - HEADER_SIZE - len(trace_header) - FRAGMENT_HEADER.size
+    count = (len(payload) + chunk_size - 1) // chunk_size
+    msg_id = next(message_ids) & 0xFFFFFFFF
+    fragments = []
+    for index in range(count):
+        chunk = payload[index * chunk_size:(index + 1) * chunk_size]
+        fragments.append(HEADER.pack(FRAME_MAGIC, type_code, target, ttl, flags, len(chunk))
+                         + trace_header + FRAGMENT_HEADER.pack(msg_id, index, count) + chunk)
+    return fragments
+
+class Reassembler:
+# collects fragments per (sender, msg_id) until a frame is complete
+# bounded in total bytes held, oldest partial messages are dropped first, and
+# partial messages older than the timeout are dropped
+    def __init__(self, timeout=REASSEMBLY_TIMEOUT, max_bytes=REASSEMBLY_MAX_BYTES):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.partial = OrderedDict() # (addr, msg_id): {'pieces', 'received', 'bytes', 'started', 'type', 'target', 'trace'}
+        self.held_bytes = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def add(self, buf, addr):
+        # returns the complete frame once the last piece is in, None until then.
+        # ValueError for a piece too short for its headers or one of no pieces
+        if len(buf) < payload_offset(buf):
+            raise ValueError(f"fragment of {len(buf)} bytes is shorter than its headers")
+        type_code, target, ttl, _, length = read_header(buf)
+        msg_id, index, count = FRAGMENT_HEADER.unpack_from(buf, fragment_offset(buf))
+        if count == 0:
+            raise ValueError("fragment of a message with no pieces")
+        offset = payload_offset(buf)
+        chunk = bytes(buf[offset:offset + length])
+        key = (tuple(addr), msg_id)
+        now = time.monotonic()
+        with self.lock:
+            self.expire(now)
+            entry = self.partial.get(key)
+            if entry is None:
+                entry = {'pieces': [None] * count, 'received': 0, 'bytes': 0, 'started': now,
+                         'type': type_code, 'target': target, 'trace': trace_id(buf)}
+                self.partial[key] = entry
+            if index >= len(entry['pieces']) or entry['pieces'][index] is not None:
+                return None
+            entry['pieces'][index] = chunk
+            entry['received'] += 1
+            entry['bytes'] += len(chunk)
+            self.held_bytes += len(chunk)
+            if entry['received'] == len(entry['pieces']):
+                del self.partial[key]
+                self.held_bytes -= entry['bytes']
+                payload = b''.join(entry['pieces'])
+                if entry['trace'] is not None:
+                    return (HEADER.pack(FRAME_MAGIC, entry['type'], entry['target'], ttl, FLAG_TRACE, len(payload))
+                            + TRACE_HEADER.pack(entry['trace']) + payload)
+                return HEADER.pack(FRAME_MAGIC, entry['type'], entry['target'], ttl, 0, len(payload)) + payload
+            while self.held_bytes > self.max_bytes and self.partial:
+                self.drop(next(iter(self.partial)))
+        return None
+
+    def expire(self, now):
+        while self.partial:
+            key, entry = next(iter(self.partial.items()))
+            if now - entry['started'] < self.timeout:
+                break
+            self.drop(key)
+
+    def drop(self, key):
+        entry = self.partial.pop(key)
+        self.held_bytes -= entry['bytes']
+        self.dropped += 1
+
+def decode(buf):
+    # the full message, for the node the frame is addressed to
+    length = read_header(buf)[4]
+    offset = payload_offset(buf)
+    return json.loads(bytes(buf[offset:offset + length]))
+
+def decode_datagram(buf):
+    # a complete message from either a frame or a plain JSON datagram
+    if is_frame(buf):
+        return decode(buf)
+    return json.loads(bytes(buf))
+
+# stream channels (the TCP bulk channel between ring neighbours) carry the same frames,
+# each prefixed with its length. No fragmentation is needed there
+LENGTH_PREFIX = struct.Struct('!I')
+
+def write_stream(sock, frame):
+    sock.sendall(LENGTH_PREFIX.pack(len(frame)))
+    sock.sendall(frame)
+
+def read_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:], n - received)
+        if count == 0:
+            return None
+        received += count
+    return buf
+
+def read_stream(sock):
+    # the next frame on the stream, or None once the other side has closed it
+    prefix = read_exact(sock, LENGTH_PREFIX.size)
+    if prefix is None:
+        return None
+    (length,) = LENGTH_PREFIX.unpack(prefix)
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError(f"stream frame of {length} bytes is larger than {MAX_MESSAGE_SIZE}")
+    return read_exact(sock, length)
@@ -0,0 +1,301 @@
+# load generator for the manager
+# simulates many virtual peers from a few processes and speaks the same JSON-over-UDP
+# command set as peer.py (register, query-dht, deregister) against a running manager
+#
+# example:
+#   python manager.py 15000 19999
+#   python loadgen.py --peers 2000 --processes 4 --rate 5000 --duration 10 --mix register=40,query-dht=40,deregister=20 --port-range 15001-19999
+#
+# every virtual peer needs two ports from the manager's range (15000-15499 unless the manager is
+# started with another one), so --port-range has to match it and hold two ports per virtual peer.
+# Peers beyond that wrap around and share ports with earlier ones, and fail to register while
+# those are registered
+#
+# every request carries a 'request-id' which the manager echoes back, so each process can keep
+# many requests in flight on one socket and still match responses to requests
+#
+# --register-batch N registers every virtual peer up front with register-batch messages of N
+# peers each (the way a fleet starting on one host would) and reports how long that took
+
+import socket
+import json
+import time
+import random
+import argparse
+import selectors
+import multiprocessing
+
+import framing
+
+DEFAULT_MIX = 'register=40,query-dht=40,deregister=20'
+
+def parse_mix(mix):
+    # "register=40,query-dht=40,deregister=20" -> (['register', ...], [40, ...])
+    commands = []
+    weights = []
+    for part in mix.split(','):
+        command, weight = part.split('=')
+        command = command.strip()
+        if command not in ('register', 'query-dht', 'deregister'):
+            raise ValueError(f"unsupported command in mix: {command}")
+        commands.append(command)
+        weights.append(float(weight))
+    return commands, weights
+
+def peer_name_for(index):
+    # peer names must be alphabetic, so spell the index out in letters
+    letters = ''
+    index += 1
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord('a') + rem) + letters
+    return 'lg' + letters
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+def parse_port_range(text):
+    # "15001-15499" -> (15001, 15499)
+    low, high = (int(port) for port in text.split('-'))
+    if high <= low:
+        raise ValueError(f"empty port range: {text}")
+    return low, high
+
+def port_pairs(port_range):
+    # how many virtual peers fit in the range, at two ports each
+    low, high = port_range
+    return (high - low + 1) // 2
+
+def register_request(args, index):
+    name = peer_name_for(index)
+    if args.auto_ports:
+        # let the manager pick the ports
+        return {'peer_name': name, 'IPv4_address': '127.0.0.1'}
+    m_port = args.port_range[0] + 2 * (index % port_pairs(args.port_range))
+    return {'peer_name': name, 'IPv4_address': '127.0.0.1', 'm_port': m_port, 'p_port': m_port + 1}
+
+def register_batches(sock, manager_addr, args, indexes, registered, by_status):
+    # register the given peers with register-batch messages, one batch in flight at a time
+    # returns the number of batches that got no response
+    reassembler = framing.Reassembler()
+    lost = 0
+    for offset in range(0, len(indexes), args.register_batch):
+        batch = indexes[offset:offset + args.register_batch]
+        request = {'command': 'register-batch', 'peers': [register_request(args, i) for i in batch]}
+        for datagram in framing.split(json.dumps(request).encode()):
+            sock.sendto(datagram, manager_addr)
+        response = None
+        deadline = time.monotonic() + args.timeout
+        while response is None and time.monotonic() < deadline:
+            try:
+                data, addr = sock.recvfrom(framing.RECV_BUFFER_SIZE)
+            except BlockingIOError:
+                time.sleep(0.001)
+                continue
+            if framing.is_fragment(data):
+                data = reassembler.add(data, addr)
+                if data is None:
+                    continue
+            response = framing.decode_datagram(data)
+        if response is None:
+            lost += 1
+            continue
+        for index, result in zip(batch, response.get('results', [])):
+            key = f"register-batch:{result['status']}"
+            by_status[key] = by_status.get(key, 0) + 1
+            if result['status'] == 'SUCCESS':
+                registered[index] = True
+    return lost
+
+def run_worker(worker_id, args, results):
+    # one worker process owns a slice of the virtual peers and one UDP socket
+    manager_addr = (args.manager_ip, args.manager_port)
+    commands, weights = parse_mix(args.mix)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(('0.0.0.0', 0))
+    sock.setblocking(False)
+    sel = selectors.DefaultSelector()
+    sel.register(sock, selectors.EVENT_READ)
+
+    # virtual peers owned by this worker: index -> registered?
+    my_peers = list(range(worker_id, args.peers, args.processes))
+    registered = {i: False for i in my_peers}
+    busy = set()  # peers with a request in flight
+
+    outstanding = {}  # request-id: (command, peer index, send time)
+    latencies = []
+    stats = {'sent': 0, 'received': 0, 'lost': 0, 'skipped': 0, 'late': 0, 'errors': 0}
+    by_status = {}
+
+    prefill_time = 0.0
+    if args.register_batch > 0:
+        prefill_start = time.monotonic()
+        stats['batches-lost'] = register_batches(sock, manager_addr, args, my_peers, registered, by_status)
+        prefill_time = time.monotonic() - prefill_start
+
+    interval = args.processes / float(args.rate) if args.rate > 0 else 0.0
+    next_id = 0
+    start = time.monotonic()
+    send_deadline = start + args.duration
+    next_send = start
+
+    def handle_response(data):
+        try:
+            response = json.loads(data.decode())
+        except Exception:
+            stats['errors'] += 1
+            return
+        request_id = response.get('request-id')
+        if request_id not in outstanding:
+            # response arrived after we gave up on the request
+            stats['late'] += 1
+            return
+        command, index, sent_at = outstanding.pop(request_id)
+        busy.discard(index)
+        latencies.append(time.monotonic() - sent_at)
+        stats['received'] += 1
+        status = response.get('status')
+        if response.get('message') == 'overloaded':
+            # turned away by the manager's admission control
+            status = 'OVERLOADED'
+        key = f"{command}:{status}"
+        by_status[key] = by_status.get(key, 0) + 1
+        if status == 'SUCCESS':
+            if command == 'register':
+                registered[index] = True
+            elif command == 'deregister':
+                registered[index] = False
+
+    def build_request(command, index):
+        if command == 'register':
+            request = register_request(args, index)
+            request['command'] = 'register'
+            return request
+        return {'command': command, 'peer_name': peer_name_for(index)}
+
+    while True:
+        now = time.monotonic()
+        if now >= send_deadline and not outstanding:
+            break
+        if now >= send_deadline + args.timeout:
+            break
+
+        # send everything that is due according to the target rate, one request per pass
+        # when there is no target rate
+        due = now < send_deadline and now >= next_send
+        while due:
+            next_send += interval
+            due = interval > 0.0 and now >= next_send
+            command = random.choices(commands, weights)[0]
+            # register makes sense for unregistered peers, the rest for registered ones
+            wanted = command != 'register'
+            candidates = [i for i in random.sample(my_peers, min(8, len(my_peers)))
+                          if i not in busy and registered[i] == wanted]
+            if not candidates:
+                stats['skipped'] += 1
+                continue
+            index = candidates[0]
+            next_id += 1
+            request_id = f"{worker_id}-{next_id}"
+            request = build_request(command, index)
+            request['request-id'] = request_id
+            try:
+                sock.sendto(json.dumps(request).encode(), manager_addr)
+            except (BlockingIOError, OSError):
+                stats['errors'] += 1
+                continue
+            outstanding[request_id] = (command, index, time.monotonic())
+            busy.add(index)
+            stats['sent'] += 1
+
+        # drain responses until the next send is due
+        wait = max(0.0, min(next_send - time.monotonic(), 0.05)) if now < send_deadline else 0.05
+        for _ in sel.select(timeout=wait):
+            while True:
+                try:
+                    data, _ = sock.recvfrom(65535)
+                except BlockingIOError:
+                    break
+                handle_response(data)
+
+        # requests without a response within the timeout count as lost
+        expired_before = time.monotonic() - args.timeout
+        for request_id in [r for r, (_, _, t) in outstanding.items() if t < expired_before]:
+            _, index, _ = outstanding.pop(request_id)
+            busy.discard(index)
+            stats['lost'] += 1
+
+    stats['lost'] += len(outstanding)
+    results.put({'stats': stats, 'by_status': by_status, 'latencies': latencies, 'prefill_time': prefill_time,
+                 'elapsed': min(time.monotonic() - start, args.duration + args.timeout)})
+    sock.close()
+
+def report(args, outputs):
+    totals = {}
+    by_status = {}
+    latencies = []
+    for output in outputs:
+        for key, value in output['stats'].items():
+            totals[key] = totals.get(key, 0) + value
+        for key, value in output['by_status'].items():
+            by_status[key] = by_status.get(key, 0) + value
+        latencies.extend(output['latencies'])
+    latencies.sort()
+
+    sent = totals.get('sent', 0)
+    received = totals.get('received', 0)
+    lost = totals.get('lost', 0)
+    print(f"virtual peers: {args.peers}  processes: {args.processes}  target rate: {args.rate}/s  duration: {args.duration}s")
+    if args.register_batch > 0:
+        prefill_time = max(output['prefill_time'] for output in outputs)
+        registered = by_status.get('register-batch:SUCCESS', 0)
+        print(f"register-batch: {registered} peers in batches of {args.register_batch} in {prefill_time:.3f}s"
+              f"  batches lost: {totals.get('batches-lost', 0)}")
+    print(f"sent: {sent}  received: {received}  lost: {lost}  late: {totals.get('late', 0)}  skipped: {totals.get('skipped', 0)}  errors: {totals.get('errors', 0)}")
+    print(f"offered: {sent / args.duration:.1f} req/s  achieved: {received / args.duration:.1f} resp/s  loss: {100.0 * lost / sent if sent else 0.0:.2f}%")
+    if latencies:
+        ms = [l * 1000.0 for l in latencies]
+        print("latency ms: "
+              f"min {ms[0]:.3f}  p50 {percentile(ms, 50):.3f}  p90 {percentile(ms, 90):.3f}  "
+              f"p99 {percentile(ms, 99):.3f}  p99.9 {percentile(ms, 99.9):.3f}  max {ms[-1]:.3f}")
+    for key in sorted(by_status):
+        print(f"  {key}: {by_status[key]}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic load generator for the DHT manager')
+    parser.add_argument('--manager-ip', default='127.0.0.1')
+    parser.add_argument('--manager-port', type=int, default=15000)
+    parser.add_argument('--peers', type=int, default=1000, help='number of virtual peers')
+    parser.add_argument('--processes', type=int, default=2, help='number of sender processes')
+    parser.add_argument('--rate', type=float, default=1000.0, help='total requests per second (0 = as fast as possible)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds to send for')
+    parser.add_argument('--timeout', type=float, default=1.0, help='seconds before a request counts as lost')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='command mix, e.g. ' + DEFAULT_MIX)
+    parser.add_argument('--port-range', type=parse_port_range, default='15001-15499',
+                        help="ports handed to virtual peers, MIN-MAX, inside the manager's range")
+    parser.add_argument('--auto-ports', action='store_true', help='register without ports and let the manager assign them')
+    parser.add_argument('--register-batch', type=int, default=0, help='register every peer up front with register-batch messages of this many peers')
+    args = parser.parse_args()
+    parse_mix(args.mix)
+    if args.peers > port_pairs(args.port_range):
+        low, high = args.port_range
+        print(f"warning: {args.peers} virtual peers but only {port_pairs(args.port_range)} port pairs in {low}-{high}, "
+              f"the rest share ports and fail to register. Start the manager with a wider range "
+              f"(python manager.py MIN MAX) and pass it with --port-range")
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=run_worker, args=(i, args, results)) for i in range(args.processes)]
+    for w in workers:
+        w.start()
+    outputs = [results.get() for _ in workers]
+    for w in workers:
+        w.join()
+    report(args, outputs)
+
+if __name__ == "__main__":
+    main()
@@ -3,76 +3,580 @@ import socket
 import sys
 import random
 import json
+import os
+import time
+import threading
+import framing
+import profiling
+from collections import deque
 
 class PeerState:
     FREE = 'Free'
     LEADER = 'Leader'
     INDHT = 'InDHT'
 
-class PortManager:
+class PeerHealth:
+# liveness of a registered peer, based on how long ago we last heard from it
+    ALIVE = 'Alive'
+    SUSPECT = 'Suspect'
+    DEAD = 'Dead'
+
+# peers heartbeat the manager every second or so
+SUSPECT_AFTER = 3.0
+DEAD_AFTER = 9.0
+HEALTH_CHECK_INTERVAL = 0.5
+
+DEFAULT_DHT = 'default'
+
+# how query-dht picks the entry node among the live members of a DHT:
+#   'p2c'           two random members, the less loaded one (default)
+#   'least-loaded'  the least loaded member
+#   'random'        any member
+# load is what each peer reports with its heartbeats (queued messages plus queries handled
+# per second) plus the queries we sent its way since that report
+ENTRY_POLICY = 'p2c'
+
+class DHT:
+# one named DHT (e.g. one per year or tenant), each with its own lifecycle
+# members are peer names with the leader first
+    def __init__(self, name, leader, members, year):
+        self.name = name
+        self.leader = leader
+        self.members = members
+        self.year = year
+        self.ready = False
+        self.teardown_in_progress = False
+
 # available port numbers for our group: 15000 - 15499
-    def __init__(self):
-        self.min_port = 15000
-        self.max_port = 15499
-        self.used_ports = set()
-    
+MIN_PORT = 15000
+MAX_PORT = 15499
+LEASE_TIME = 30.0           # seconds a peer's ports stay reserved without any activity from it
+LEASE_SWEEP_INTERVAL = 5.0
+
+class PortManager:
+# a bitmap over [min_port, max_port] marks used ports, and free ports are kept in a queue
+# so assign_port() is O(1). The queue is cleaned lazily: ports reserved by number stay
+# queued and are skipped when they come up. A second bitmap marks the queued ports so a
+# released port is only queued again if it isn't still there
+# ports handed to peers are leased and have to be renewed by activity, expired leases
+# are collected by the manager's sweep
+    def __init__(self, min_port=MIN_PORT, max_port=MAX_PORT, lease_time=LEASE_TIME):
+        self.min_port = min_port
+        self.max_port = max_port
+        self.lease_time = lease_time
+        self.bitmap = bytearray((max_port - min_port) // 8 + 1)
+        self.free_ports = deque(range(min_port, max_port + 1))
+        self.queued = bytearray(b'\xff' * len(self.bitmap))
+        self.leases = {} # port: lease expiry
+        self.used_count = 0
+
+    def in_range(self, port):
+        return isinstance(port, int) and self.min_port <= port <= self.max_port
+
+    def test_bit(self, bitmap, port):
+        offset = port - self.min_port
+        return bitmap[offset >> 3] & (1 << (offset & 7)) != 0
+
+    def set_bit(self, bitmap, port, value):
+        offset = port - self.min_port
+        if value:
+            bitmap[offset >> 3] |= 1 << (offset & 7)
+        else:
+            bitmap[offset >> 3] &= ~(1 << (offset & 7)) & 0xFF
+
+    def is_used(self, port):
+        return self.test_bit(self.bitmap, port)
+
+    def mark(self, port, used):
+        self.set_bit(self.bitmap, port, used)
+
     def reserve_port(self, port):
-        if port < self.min_port or port > self.max_port:
+        if not self.in_range(port):
             return False
-        if port in self.used_ports:
+        if self.is_used(port):
             return False
-        self.used_ports.add(port)
+        self.mark(port, True)
+        self.used_count += 1
         return True
     
     def release_port(self, port):
-        if port in self.used_ports:
-            self.used_ports.remove(port)
+        if self.in_range(port) and self.is_used(port):
+            self.mark(port, False)
+            self.used_count -= 1
+            self.leases.pop(port, None)
+            if not self.test_bit(self.queued, port):
+                self.set_bit(self.queued, port, True)
+                self.free_ports.append(port)
 
     def is_available(self, port):
-        return port not in self.used_ports and port >= self.min_port and port <= self.max_port
+        return self.in_range(port) and not self.is_used(port)
+
+    def assign_port(self):
+        # a free port, reserved, or None when the range is exhausted
+        while self.free_ports:
+            port = self.free_ports.popleft()
+            self.set_bit(self.queued, port, False)
+            if self.reserve_port(port):
+                return port
+        return None
+
+    def assign_pair(self):
+        # (m_port, p_port) for a peer that didn't pick its own
+        m_port = self.assign_port()
+        p_port = self.assign_port()
+        if p_port is None:
+            if m_port is not None:
+                self.release_port(m_port)
+            return None
+        return m_port, p_port
+
+    @property
+    def used_ports(self):
+        return {port for port in range(self.min_port, self.max_port + 1) if self.is_used(port)}
+
+    def lease(self, port, now=None):
+        # (re)start the lease on a reserved port
+        if self.in_range(port) and self.is_used(port):
+            self.leases[port] = (now if now is not None else time.monotonic()) + self.lease_time
+
+    def expired_leases(self, now=None):
+        now = now if now is not None else time.monotonic()
+        return [port for port, expiry in self.leases.items() if expiry <= now]
     
+class StateLog:
+# write-ahead log of SIB transitions plus a periodic compacted snapshot
+# every transition is appended as one JSON line before it is acknowledged; every
+# snapshot_every records the full state is written to a snapshot and the log is truncated
+# on startup the manager loads the snapshot and replays the log on top of it
+# records carry a sequence number and the snapshot the last one it includes, so records that
+# are already in the snapshot (a crash between writing it and truncating the log) are skipped
+    def __init__(self, directory, snapshot_every=1000, fsync=False):
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, 'sib.log')
+        self.snapshot_path = os.path.join(directory, 'sib.snapshot')
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.records_since_snapshot = 0
+        self.sequence = 0       # of the last record appended, or loaded
+        self.log_file = None
+
+    def load(self):
+        # returns (snapshot or None, list of records logged after it)
+        snapshot = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as file:
+                snapshot = json.load(file)
+        self.sequence = snapshot.get('seq', 0) if snapshot is not None else 0
+        records = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write at the tail from a crash, nothing after it was acknowledged
+                        break
+                    if record.get('seq', self.sequence + 1) <= self.sequence:
+                        continue
+                    self.sequence = record.get('seq', self.sequence)
+                    records.append(record)
+        self.records_since_snapshot = len(records)
+        return snapshot, records
+
+    def append(self, record):
+        if self.log_file is None:
+            self.log_file = open(self.log_path, 'a')
+        self.sequence += 1
+        record['seq'] = self.sequence
+        self.log_file.write(json.dumps(record) + '\n')
+        self.log_file.flush()
+        if self.fsync:
+            os.fsync(self.log_file.fileno())
+        self.records_since_snapshot += 1
+
+    def needs_snapshot(self):
+        return self.records_since_snapshot >= self.snapshot_every
+
+    def write_snapshot(self, state):
+        # write to a temp file and rename so a crash never leaves a half-written snapshot
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(dict(state, seq=self.sequence), file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        if self.log_file is not None:
+            self.log_file.close()
+        self.log_file = open(self.log_path, 'w')
+        self.records_since_snapshot = 0
+
+# admission control: a receive thread sorts requests into one queue per priority and the
+# manager serves the highest priority first. Lifecycle commands that unblock a DHT come first,
+# then liveness, then membership, then queries. When a queue is full, or a source sends faster
+# than its rate limit, the request is answered right away with FAILURE: overloaded instead of
+# waiting in line (or being dropped by the kernel)
+PRIORITY_LIFECYCLE = 0
+PRIORITY_LIVENESS = 1
+PRIORITY_MEMBERSHIP = 2
+PRIORITY_QUERY = 3
+COMMAND_PRIORITY = {
+    'setup-dht': PRIORITY_LIFECYCLE,
+    'dht-complete': PRIORITY_LIFECYCLE,
+    'teardown-dht': PRIORITY_LIFECYCLE,
+    'teardown-complete': PRIORITY_LIFECYCLE,
+    'heartbeat': PRIORITY_LIVENESS,
+    'suspect-peer': PRIORITY_LIVENESS,
+    'profile-start': PRIORITY_LIVENESS,
+    'profile-stop': PRIORITY_LIVENESS,
+    'register': PRIORITY_MEMBERSHIP,
+    'register-batch': PRIORITY_MEMBERSHIP,
+    'deregister': PRIORITY_MEMBERSHIP,
+    'deregister-batch': PRIORITY_MEMBERSHIP,
+}   # anything else is served as a query
+QUEUE_LIMITS = (4096, 4096, 1024, 1024)    # requests waiting per priority
+SOURCE_RATE = 2000.0        # requests per second from one address, lifecycle and liveness are exempt
+SOURCE_BURST = 4000.0
+
+class AdmissionQueue:
+# requests waiting for the manager, one FIFO per priority, highest priority (lowest number) first
+    def __init__(self, limits=QUEUE_LIMITS):
+        self.limits = limits
+        self.queues = [deque() for _ in limits]
+        self.condition = threading.Condition()
+
+    def put(self, priority, item):
+        # False if that priority's queue is full
+        with self.condition:
+            if len(self.queues[priority]) >= self.limits[priority]:
+                return False
+            self.queues[priority].append(item)
+            self.condition.notify()
+            return True
+
+    def get(self, timeout):
+        # the next request to serve, None if nothing came in within the timeout
+        with self.condition:
+            if not any(self.queues):
+                self.condition.wait(timeout)
+            for waiting in self.queues:
+                if waiting:
+                    return waiting.popleft()
+            return None
+
+class RateLimiter:
+# token bucket per source address
+# allow is called by the receive thread and prune by the serving loop
+    def __init__(self, rate=SOURCE_RATE, burst=SOURCE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {} # addr: [tokens, time of last refill]
+        self.lock = threading.Lock()
+
+    def allow(self, addr, now):
+        with self.lock:
+            bucket = self.buckets.get(addr)
+            if bucket is None:
+                bucket = self.buckets[addr] = [self.burst, now]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                return False
+            bucket[0] -= 1.0
+            return True
+
+    def prune(self, now):
+        # forget sources that have been quiet long enough to have a full bucket again
+        with self.lock:
+            for addr in [a for a, (_, last) in self.buckets.items() if now - last > self.burst / self.rate]:
+                del self.buckets[addr]
+
 class Manager:
-    def __init__(self, host_ip, host_port, port_manager):
+    def __init__(self, host_ip, host_port, port_manager, state_log=None, bind=True):
     # manager maintains a state information base (SIB) of all registered peers
     # SIB is a dictionary with peer_name as key and a 3-tuple as value
     # 3-tuple is (IPv4_address, m_port, p_port)
     # state of each peer is Free, InDHT, or Leader
+    # bind=False leaves out the socket, for driving handle_message directly (simulator.py)
         self.addr = (host_ip, host_port)
         self.peers = {} # peer_name: (IPv4_address, m_port, p_port)
         self.peer_states = {} # peer_name: state
         self.port_manager = port_manager
 
-        self.dht_exists = False
-        self.dht_ready = False
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.bind(self.addr)
+        self.dhts = {} # dht_name: DHT
+        self.peer_dht = {} # peer_name: dht_name, for peers that are Leader or InDHT
+        # liveness is soft state, it is not logged and starts fresh after a restart
+        self.last_seen = {} # peer_name: time of last message
+        self.peer_health = {} # peer_name: PeerHealth
+        self.peer_load = {} # peer_name: load from its last heartbeat
+        self.assigned = {} # peer_name: queries sent its way since that heartbeat
+        self.last_health_check = time.monotonic()
+        self.reassembler = framing.Reassembler()
+        self.admission = AdmissionQueue()
+        self.rate_limiter = RateLimiter()
+        self.rejected = 0 # requests answered with overloaded
+        self.profiler = profiling.ProfileControl()
+        self.last_lease_sweep = time.monotonic()
+        self.socket = None
+        if bind:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind(self.addr)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, framing.SOCKET_BUFFER_SIZE)
         self.port_manager.reserve_port(host_port)
 
-        self.teardown_in_progress = False
-
-        print(f"Manager listening on {host_ip}:{host_port}")
+        self.state_log = state_log
+        if self.state_log is not None:
+            self.recover()
+
+        if bind:
+            print(f"Manager listening on {host_ip}:{host_port}")
+
+    def recover(self):
+    # rebuild the SIB from the last snapshot plus the log written after it
+        start = time.perf_counter()
+        snapshot, records = self.state_log.load()
+        if snapshot is not None:
+            self.restore(snapshot)
+        for record in records:
+            self.apply(record)
+        if records:
+            # compact right away so the next restart only loads the snapshot
+            self.state_log.write_snapshot(self.snapshot())
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"[Manager] Recovered {len(self.peers)} peers and {len(self.dhts)} DHTs ({len(records)} log records) in {elapsed:.1f} ms")
+
+    def snapshot(self):
+        return {'peers': self.peers,
+                'peer_states': self.peer_states,
+                'peer_dht': self.peer_dht,
+                'dhts': {name: vars(dht) for name, dht in self.dhts.items()}}
+
+    def restore(self, snapshot):
+        self.peers = snapshot['peers']
+        self.peer_states = snapshot['peer_states']
+        self.peer_dht = snapshot['peer_dht']
+        self.dhts = {}
+        for name, fields in snapshot['dhts'].items():
+            dht = DHT(fields['name'], fields['leader'], fields['members'], fields['year'])
+            dht.ready = fields['ready']
+            dht.teardown_in_progress = fields['teardown_in_progress']
+            self.dhts[name] = dht
+        for peer_info in self.peers.values():
+            self.port_manager.reserve_port(peer_info['m_port'])
+            self.port_manager.reserve_port(peer_info['p_port'])
+            self.port_manager.lease(peer_info['m_port'])
+            self.port_manager.lease(peer_info['p_port'])
+
+    def commit(self, record):
+    # every change to the SIB goes through here: log it, then apply it
+        if self.state_log is not None:
+            self.state_log.append(record)
+        self.apply(record)
+        if self.state_log is not None and self.state_log.needs_snapshot():
+            self.state_log.write_snapshot(self.snapshot())
+
+    def apply(self, record):
+        op = record['op']
+        if op == 'register':
+            self.peers[record['peer_name']] = {
+                'ip': record['ip'],
+                'm_port': record['m_port'],
+                'p_port': record['p_port']
+            }
+            self.peer_states[record['peer_name']] = PeerState.FREE
+            self.port_manager.reserve_port(record['m_port'])
+            self.port_manager.reserve_port(record['p_port'])
+            self.port_manager.lease(record['m_port'])
+            self.port_manager.lease(record['p_port'])
+        elif op == 'deregister':
+            peer_info = self.peers.pop(record['peer_name'])
+            self.port_manager.release_port(peer_info['m_port'])
+            self.port_manager.release_port(peer_info['p_port'])
+            del self.peer_states[record['peer_name']]
+        elif op == 'setup-dht':
+            members = record['members']
+            self.peer_states[members[0]] = PeerState.LEADER
+            for peer in members[1:]:
+                self.peer_states[peer] = PeerState.INDHT
+            for peer in members:
+                self.peer_dht[peer] = record['dht']
+            self.dhts[record['dht']] = DHT(record['dht'], members[0], members, record['year'])
+        elif op == 'dht-complete':
+            self.dhts[record['dht']].ready = True
+        elif op == 'teardown-dht':
+            self.dhts[record['dht']].teardown_in_progress = True
+        elif op == 'teardown-complete':
+            dht = self.dhts.pop(record['dht'])
+            for peer in dht.members:
+                if peer in self.peer_states:
+                    self.peer_states[peer] = PeerState.FREE
+                self.peer_dht.pop(peer, None)
 
     def listen(self):
+    # requests are read by the receive thread and served here, one at a time, by priority
+        threading.Thread(target=self.receive, daemon=True).start()
         while True:
-            data, peer_addr = self.socket.recvfrom(4096)
+            if time.monotonic() - self.last_health_check >= HEALTH_CHECK_INTERVAL:
+                self.check_health()
+            if time.monotonic() - self.last_lease_sweep >= LEASE_SWEEP_INTERVAL:
+                self.sweep_leases()
+                self.rate_limiter.prune(time.monotonic())
+            request = self.admission.get(HEALTH_CHECK_INTERVAL)
+            if request is None:
+                continue
+            message, peer_addr = request
             try:
-                message = json.loads(data.decode())
                 response = self.handle_message(message)
             except Exception as e:
                 response = {'status': 'FAILURE', 'message': str(e)}
+            self.respond(message, response, peer_addr)
 
-            self.socket.sendto(json.dumps(response).encode(), peer_addr)
+    def receive(self):
+    # receive thread: decode, then queue by priority or turn the request away if we can't keep up
+        while True:
+            data, peer_addr = self.socket.recvfrom(framing.RECV_BUFFER_SIZE)
+            try:
+                if framing.is_fragment(data):
+                    # large requests arrive in pieces, wait for the rest
+                    data = self.reassembler.add(data, peer_addr)
+                    if data is None:
+                        continue
+                message = framing.decode_datagram(data)
+                command = message.get('command')
+            except Exception as e:
+                self.respond({}, {'status': 'FAILURE', 'message': str(e)}, peer_addr)
+                continue
+            priority = COMMAND_PRIORITY.get(command, PRIORITY_QUERY)
+            if priority > PRIORITY_LIVENESS and not self.rate_limiter.allow(peer_addr, time.monotonic()):
+                self.reject(message, command, peer_addr, 'rate limit exceeded')
+            elif not self.admission.put(priority, (message, peer_addr)):
+                self.reject(message, command, peer_addr, 'queue full')
+
+    def reject(self, message, command, peer_addr, reason):
+        self.rejected += 1
+        self.respond(message, {'status': 'FAILURE', 'message': 'overloaded', 'reason': reason,
+                               'command-type': command}, peer_addr)
+
+    def respond(self, message, response, peer_addr):
+        # echo the request id so clients with many requests in flight can match responses
+        if isinstance(message, dict) and 'request-id' in message:
+            response['request-id'] = message['request-id']
+        for datagram in framing.split(json.dumps(response).encode()):
+            self.socket.sendto(datagram, peer_addr)
+
+    def touch(self, peer_name):
+    # any message from a registered peer counts as a sign of life and renews its port leases
+        if peer_name in self.peers:
+            now = time.monotonic()
+            self.last_seen[peer_name] = now
+            self.peer_health[peer_name] = PeerHealth.ALIVE
+            self.port_manager.lease(self.peers[peer_name]['m_port'], now)
+            self.port_manager.lease(self.peers[peer_name]['p_port'], now)
+
+    def sweep_leases(self):
+    # free the ports of Free peers whose leases ran out (crashed without deregistering)
+    # peers in a DHT keep their ports until the DHT is torn down
+        now = time.monotonic()
+        self.last_lease_sweep = now
+        expired = set(self.port_manager.expired_leases(now))
+        if not expired:
+            return
+        for peer_name, peer_info in list(self.peers.items()):
+            if peer_info['m_port'] not in expired and peer_info['p_port'] not in expired:
+                continue
+            if self.peer_states.get(peer_name) == PeerState.FREE:
+                print(f"[Manager] Lease of {peer_name} expired, reclaiming ports {peer_info['m_port']} and {peer_info['p_port']}")
+                self.commit({'op': 'deregister', 'peer_name': peer_name})
+            else:
+                self.port_manager.lease(peer_info['m_port'], now)
+                self.port_manager.lease(peer_info['p_port'], now)
+
+    def is_alive(self, peer_name):
+        return self.peer_health.get(peer_name, PeerHealth.ALIVE) == PeerHealth.ALIVE
+
+    def check_health(self):
+    # mark peers we haven't heard from as Suspect, then Dead
+        now = time.monotonic()
+        self.last_health_check = now
+        for peer_name in self.peers:
+            silent = now - self.last_seen.setdefault(peer_name, now)
+            if silent >= DEAD_AFTER:
+                health = PeerHealth.DEAD
+            elif silent >= SUSPECT_AFTER:
+                health = PeerHealth.SUSPECT
+            else:
+                continue
+            if self.peer_health.get(peer_name) != health:
+                self.peer_health[peer_name] = health
+                print(f"[Manager] Peer {peer_name} is {health}")
+
+    def heartbeat(self, message):
+        load = message.get('load')
+        if load is not None and message.get('peer_name') in self.peers:
+            self.peer_load[message.get('peer_name')] = load.get('queued', 0) + load.get('queries', 0)
+            self.assigned[message.get('peer_name')] = 0
+        return {'status': 'SUCCESS', 'command-type': 'heartbeat'}
+
+    def load_of(self, peer_name):
+        return self.peer_load.get(peer_name, 0) + self.assigned.get(peer_name, 0)
+
+    def pick_entry(self, candidates):
+    # entry node for a query among the live members of a DHT, see ENTRY_POLICY
+        if ENTRY_POLICY == 'least-loaded':
+            lowest = min(self.load_of(peer) for peer in candidates)
+            peer_name = random.choice([peer for peer in candidates if self.load_of(peer) == lowest])
+        elif ENTRY_POLICY == 'p2c' and len(candidates) > 1:
+            first, second = random.sample(candidates, 2)
+            peer_name = first if self.load_of(first) <= self.load_of(second) else second
+        else:
+            peer_name = random.choice(candidates)
+        self.assigned[peer_name] = self.assigned.get(peer_name, 0) + 1
+        return peer_name
+
+    def suspect_peer(self, message):
+    # suspect-peer <peer_name> <suspect>: a ring neighbour stopped answering heartbeats
+        suspect = message.get('suspect')
+        if suspect not in self.peers:
+            return {'status': 'FAILURE', 'message': 'Peer not registered'}
+        if self.is_alive(suspect):
+            self.peer_health[suspect] = PeerHealth.SUSPECT
+            # age it so it is declared dead unless it shows up again
+            self.last_seen[suspect] = min(self.last_seen.get(suspect, time.monotonic()), time.monotonic() - SUSPECT_AFTER)
+            print(f"[Manager] Peer {suspect} reported unresponsive by {message.get('peer_name')}")
+        return {'status': 'SUCCESS', 'command-type': 'suspect-peer'}
+
+    def dht_name(self, message):
+    # the DHT a command refers to: named explicitly, or the one the sending peer belongs to
+        if message.get('dht'):
+            return message.get('dht')
+        return self.peer_dht.get(message.get('peer_name'), DEFAULT_DHT)
 
     def handle_message(self, message):
         command = message.get('command')
 
-        if self.teardown_in_progress and command != 'teardown-complete':
-            return {'status': 'FAILURE', 'message': 'DHT teardown in progress'}
-        if self.dht_exists and not self.dht_ready and command != 'dht-complete':
-            return {'status': 'FAILURE', 'message': 'DHT setup in progress'}
+        self.touch(message.get('peer_name'))
+        # liveness traffic is never held up by DHT setup or teardown
+        if command == 'heartbeat':
+            return self.heartbeat(message)
+        if command == 'suspect-peer':
+            return self.suspect_peer(message)
+        if command in profiling.PROFILE_COMMANDS:
+            # cprofile mode profiles this thread, the one serving requests
+            return self.profiler.handle(message, 'manager')
+
+        # setup and teardown only block commands for the DHT they belong to
+        dht = self.dhts.get(self.dht_name(message))
+        if dht is not None and command in ('setup-dht', 'dht-complete', 'teardown-dht', 'teardown-complete', 'query-dht'):
+            if dht.teardown_in_progress and command != 'teardown-complete':
+                return {'status': 'FAILURE', 'message': f'DHT {dht.name} teardown in progress'}
+            if not dht.ready and command != 'dht-complete':
+                return {'status': 'FAILURE', 'message': f'DHT {dht.name} setup in progress'}
 
         if command == 'register':
             return self.register_peer(message)
+        elif command == 'register-batch':
+            return self.register_batch(message)
+        elif command == 'deregister-batch':
+            return self.deregister_batch(message)
         elif command == 'setup-dht':
             return self.setup_dht(message)
         elif command == 'dht-complete':
@@ -96,27 +600,59 @@ class Manager:
     # m_port for communication with manager, p_port for communication with peers
     # set state of peer to Free
     # if peer_name is unique return SUCCESS, else return FAILURE and do nothing
+    # m_port and p_port may be left out (or 0) to have the manager assign a free pair, they are returned either way
+    # a retried register for the same peer and address succeeds again with the same ports
         peer_name = message.get('peer_name')
         ip = message.get('IPv4_address')
-        m_port = message.get('m_port')
-        p_port = message.get('p_port')
+        m_port = message.get('m_port') or None
+        p_port = message.get('p_port') or None
 
         if peer_name in self.peers:
+            existing = self.peers[peer_name]
+            if existing['ip'] == ip and m_port in (None, existing['m_port']) and p_port in (None, existing['p_port']):
+                return {'status': 'SUCCESS', 'message': 'Peer registered', 'command-type': 'register',
+                        'm_port': existing['m_port'], 'p_port': existing['p_port']}
             return {'status': 'FAILURE', 'message': 'Peer name already exists'}
-        
-        if not self.port_manager.is_available(m_port) or not self.port_manager.is_available(p_port):
+
+        if m_port is None or p_port is None:
+            pair = self.port_manager.assign_pair()
+            if pair is None:
+                return {'status': 'FAILURE', 'message': 'No free ports'}
+            m_port, p_port = pair
+        elif not self.port_manager.is_available(m_port) or not self.port_manager.is_available(p_port) or m_port == p_port:
             return {'status': 'FAILURE', 'message': 'Port number already in use'}
         
-        self.peers[peer_name] = {
-            'ip': ip,
-            'm_port': m_port,
-            'p_port': p_port
-        }
-        self.peer_states[peer_name] = PeerState.FREE
-        self.port_manager.reserve_port(m_port)
-        self.port_manager.reserve_port(p_port)
-
-        return {'status': 'SUCCESS', 'message': 'Peer registered', 'command-type': 'register'}
+        self.commit({'op': 'register', 'peer_name': peer_name, 'ip': ip, 'm_port': m_port, 'p_port': p_port})
+
+        return {'status': 'SUCCESS', 'message': 'Peer registered', 'command-type': 'register', 'm_port': m_port, 'p_port': p_port}
+
+    def register_batch(self, message):
+    # register-batch <peers> (list of register records, e.g. every peer on one host)
+    # the records are checked in order against the SIB and against each other, so a duplicate
+    # name or port inside the batch fails just like one that is already registered
+    # returns SUCCESS with one result per record, in the same order
+        results = []
+        for record in message.get('peers') or []:
+            response = self.register_peer(record)
+            result = {'peer_name': record.get('peer_name'), 'status': response['status'], 'message': response['message']}
+            if response['status'] == 'SUCCESS':
+                result['m_port'] = response['m_port']
+                result['p_port'] = response['p_port']
+                self.touch(record.get('peer_name'))
+            results.append(result)
+        registered = sum(1 for result in results if result['status'] == 'SUCCESS')
+        return {'status': 'SUCCESS', 'message': f'{registered} of {len(results)} peers registered',
+                'command-type': 'register-batch', 'results': results}
+
+    def deregister_batch(self, message):
+    # deregister-batch <peer_names>, one result per name
+        results = []
+        for peer_name in message.get('peer_names') or []:
+            response = self.deregister_peer({'peer_name': peer_name})
+            results.append({'peer_name': peer_name, 'status': response['status'], 'message': response['message']})
+        deregistered = sum(1 for result in results if result['status'] == 'SUCCESS')
+        return {'status': 'SUCCESS', 'message': f'{deregistered} of {len(results)} peers deregistered',
+                'command-type': 'deregister-batch', 'results': results}
 
     def deregister_peer(self, message):
         peer_name = message.get('peer_name')
@@ -127,28 +663,23 @@ class Manager:
         if self.peer_states.get(peer_name) != PeerState.FREE:
             return {'status': 'FAILURE', 'message': 'Peer not in Free state'}
 
-        # Free ports
-        peer_info = self.peers[peer_name]
-        self.port_manager.release_port(peer_info['m_port'])
-        self.port_manager.release_port(peer_info['p_port'])
-
-        # Remove peer
-        del self.peers[peer_name]
-        del self.peer_states[peer_name]
+        # Remove peer and free its ports
+        self.commit({'op': 'deregister', 'peer_name': peer_name})
 
         return {'status': 'SUCCESS', 'message': 'Peer deregistered', 'command-type': 'deregister'}
 
     
     def setup_dht(self, message):
-    # setup-dht <peer_name> <n> <YYYY> (DHT of size n from year YYYY)
+    # setup-dht <peer_name> <n> <YYYY> [dht] (DHT of size n from year YYYY, named dht)
     # initiate construction of DHT of size n from year YYYY
     # manager receives a setup-dht command from a peer
-    # return FAILURE if: peer_name is not registered; n < 3; fewer than n users registered; DHT already exists
+    # return FAILURE if: peer_name is not registered; n < 3; fewer than n users registered; a DHT with that name already exists
     # else: set state of peer to Leader; select at random n-1 Free peers and set states to InDHT; return SUCCESS and list of n peers
-    # after SUCCESS, manager waits for dht-complete, returns FAILURE to any other incoming messages
+    # after SUCCESS, manager waits for dht-complete, returns FAILURE to other commands for this DHT
         leader = message.get('peer_name')
         n = message.get('n')
         year = message.get('YYYY')
+        dht_name = message.get('dht') or DEFAULT_DHT
 
         if leader not in self.peers:
             return {'status': 'FAILURE', 'message': 'Peer not registered'}
@@ -159,32 +690,28 @@ class Manager:
         if len(self.peers) < n:
             return {'status': 'FAILURE', 'message': 'Not enough peers registered'}
         
-        if self.dht_exists:
-            return {'status': 'FAILURE', 'message': 'DHT already exists'}
+        if dht_name in self.dhts:
+            return {'status': 'FAILURE', 'message': f'DHT {dht_name} already exists'}
         
-        free_peers = [peer for peer, state in self.peer_states.items() if state == PeerState.FREE]
+        # only sample peers that are still heartbeating
+        free_peers = [peer for peer, state in self.peer_states.items() if state == PeerState.FREE and self.is_alive(peer)]
         if leader not in free_peers:
             return {'status': 'FAILURE', 'message': 'Leader not free'}
         
         if len(free_peers) < n:
             return {'status': 'FAILURE', 'message': 'Not enough free peers'}
         
-        self.peer_states[leader] = PeerState.LEADER
         free_peers.remove(leader)
         in_dht_peers = random.sample(free_peers, n-1)
 
-        for peer in in_dht_peers:
-            self.peer_states[peer] = PeerState.INDHT
-        
-        self.dht_exists = True
-        self.dht_ready = False
-
+        # leader becomes Leader, the sampled peers InDHT
         dht_members = [leader] + in_dht_peers
+        self.commit({'op': 'setup-dht', 'dht': dht_name, 'members': dht_members, 'year': year})
         # DHT structure: 
         # peer is a 3-tuple (peer_name, IPv4_address, p_port)
         member_info = [(name, self.peers[name]["ip"], self.peers[name]["p_port"]) for name in dht_members]
 
-        return {'status': 'SUCCESS', 'members': member_info, 'command-type':'setup-dht', 'size': n}
+        return {'status': 'SUCCESS', 'members': member_info, 'command-type':'setup-dht', 'size': n, 'dht': dht_name}
     
     def dht_complete(self, message):
     # dht-complete <peer_name>
@@ -197,45 +724,43 @@ class Manager:
         if peer_name not in self.peers:
             return {'status': 'FAILURE', 'message': 'Peer not registered'}
         
-        if self.peer_states[peer_name] != PeerState.LEADER:
+        dht = self.dhts.get(self.dht_name(message))
+        if dht is None or dht.leader != peer_name:
             return {'status': 'FAILURE', 'message': 'Peer not leader'}
         
-        self.dht_ready = True
-        print(f"[Manager] DHT setup complete by leader {peer_name}")
+        self.commit({'op': 'dht-complete', 'dht': dht.name})
+        print(f"[Manager] DHT {dht.name} setup complete by leader {peer_name}")
 
-        return {'status': 'SUCCESS', 'message': 'DHT setup complete', 'command-type':'setup-dht'}
+        return {'status': 'SUCCESS', 'message': 'DHT setup complete', 'command-type':'dht-complete', 'dht': dht.name}
 
     def teardown_dht(self, message):
         leader = message.get('peer_name')
+        dht = self.dhts.get(self.dht_name(message))
 
-        if leader not in self.peers or self.peer_states.get(leader) != PeerState.LEADER:
+        if leader not in self.peers or dht is None or dht.leader != leader:
             return {'status': 'FAILURE', 'message': 'Peer not the DHT leader'}
 
-        self.teardown_in_progress = True
-        print(f"[Manager] Teardown initiated by leader {leader}")
-        return {'status': 'SUCCESS', 'message': 'Teardown initiated', 'command-type': 'teardown-dht'}
+        self.commit({'op': 'teardown-dht', 'dht': dht.name})
+        print(f"[Manager] Teardown of DHT {dht.name} initiated by leader {leader}")
+        return {'status': 'SUCCESS', 'message': 'Teardown initiated', 'command-type': 'teardown-dht', 'dht': dht.name}
 
     def teardown_complete(self, message):
         leader = message.get('peer_name')
+        dht = self.dhts.get(self.dht_name(message))
 
-        if leader not in self.peers or self.peer_states.get(leader) != PeerState.LEADER:
+        if leader not in self.peers or dht is None or dht.leader != leader:
             return {'status': 'FAILURE', 'message': 'Peer not the DHT leader'}
 
-        # Reset all DHT peers to Free
-        for peer, state in self.peer_states.items():
-            if state in [PeerState.INDHT, PeerState.LEADER]:
-                self.peer_states[peer] = PeerState.FREE
-
-        self.dht_exists = False
-        self.dht_ready = False
-        self.teardown_in_progress = False
+        # Reset the peers of this DHT to Free
+        self.commit({'op': 'teardown-complete', 'dht': dht.name})
 
-        print(f"[Manager] DHT teardown completed by leader {leader}")
-        return {'status': 'SUCCESS', 'message': 'DHT teardown complete', 'command-type': 'teardown-complete'}
+        print(f"[Manager] DHT {dht.name} teardown completed by leader {leader}")
+        return {'status': 'SUCCESS', 'message': 'DHT teardown complete', 'command-type': 'teardown-complete', 'dht': dht.name}
 
     def query_dht(self, message):
         peer_name = message.get("peer_name")
-        if not self.dht_ready:
+        dht = self.dhts.get(message.get('dht') or DEFAULT_DHT)
+        if dht is None or not dht.ready:
             return {'status': 'FAILURE', 'message': 'DHT set up has not been completed'}
         if not peer_name in self.peers:
             return {'status': 'FAILURE', 'message': 'Peer is not registered'}
@@ -243,16 +768,22 @@ class Manager:
         if peer_name not in free_peers:
             return {'status': 'FAILURE', 'message': 'Peer is in DHT'}
                 
-        DHTpeers = [peer for peer, state in self.peer_states.items() if state == PeerState.INDHT]
-        peer_name = random.choice(DHTpeers)
-        return {'status': 'SUCCESS','peer-name': peer_name, 'addr': self.peers[peer_name]['ip'], 'p-port': self.peers[peer_name]['p_port'], 'command-type':'query-dht'}     
+        # the leader serves queries like any other member
+        DHTpeers = [peer for peer in dht.members if self.peer_states.get(peer) in (PeerState.LEADER, PeerState.INDHT) and self.is_alive(peer)]
+        if not DHTpeers:
+            return {'status': 'FAILURE', 'message': 'No live peers in DHT'}
+        peer_name = self.pick_entry(DHTpeers)
+        return {'status': 'SUCCESS','peer-name': peer_name, 'addr': self.peers[peer_name]['ip'], 'p-port': self.peers[peer_name]['p_port'], 'command-type':'query-dht', 'dht': dht.name}     
 
 def main():
+    # python manager.py [min_port max_port], the range of ports handed to peers
     host_ip = "127.0.0.1"
     host_port = 15000
-    port_manager = PortManager()
+    min_port, max_port = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else (MIN_PORT, MAX_PORT)
+    port_manager = PortManager(min_port, max_port)
+    state_log = StateLog("./manager_state")
 
-    manager = Manager(host_ip, host_port, port_manager)
+    manager = Manager(host_ip, host_port, port_manager, state_log)
     manager.listen()
 
 if __name__ == "__main__":
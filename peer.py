@@ -98,10 +98,19 @@ import socket as s
 import threading
 import json
 import time
-import csv
 import math
 import random
-from collections import deque
+import queue
+import itertools
+import heapq
+import zlib
+import lzma
+import base64
+import framing
+import dataset_cache
+import tracing
+import profiling
+import bloom
 
 m_socket = s.socket(s.AF_INET, s.SOCK_DGRAM)
 p_socket = s.socket(s.AF_INET, s.SOCK_DGRAM)
@@ -112,9 +121,15 @@ name = ""
 identifier = -1
 ring_size = -1
 local_table = []            #hash table that is a part of the DHT
+local_index = {}            #event_id: record, for lookups in local_table
+replica_index = {}          #event_id: record, copies held for the previous replication_factor nodes
+replication_factor = 0      #extra copies of each record kept on the owner's next successors
+table_size = 0              #hash table size s, first prime larger than 2 * number of records
 three_tuple_data = []       #stores the member data
 right_neighbour_tuple = (0, 0, 0)  #stores the contact info of the right neighbor in the DHT
 year_used = 1950            #stores what year was sent to manager/data in table is from
+DEFAULT_DHT = 'default'
+dht_name = DEFAULT_DHT      #name of the DHT this peer belongs to, the manager can run several
 
 leaving = False
 joining = False
@@ -123,6 +138,131 @@ tearing_down = False
 #used in the dht-setup process only
 global_table = []       #stores global table data
 
+# receive pipeline: reciever -> inbound_queue -> dispatcher -> work_queue -> workers
+# everything outbound goes through send_queue -> sender
+INBOUND_QUEUE_SIZE = 4096
+WORK_QUEUE_SIZE = 256
+WORKER_COUNT = 4
+inbound_queue = queue.Queue(maxsize=INBOUND_QUEUE_SIZE)
+work_queue = queue.Queue(maxsize=WORK_QUEUE_SIZE)
+send_queue = queue.Queue()
+state_lock = threading.RLock()      #guards the DHT state above, shared by dispatcher and workers
+held_work = threading.local()       #jobs submitted with state_lock held, see submit_work
+pipeline_started = False
+reassembler = framing.Reassembler()    #messages bigger than a datagram arrive in fragments
+
+# store batching and compression, negotiated per ring: the leader picks the codec and
+# level and sends it with set-id. codec is 'none', 'zlib' or 'lzma'
+store_compression = {'codec': 'none', 'level': 6}
+MAX_STORE_PAYLOAD = framing.MAX_DATAGRAM - 512    #wire bytes per store-batch, keeps each batch inside one datagram
+
+# zlib is primed with field values that repeat on almost every row, so even
+# small batches compress well. Most frequent values go last, and the tail is written the
+# way a raw CSV line's end looks inside the JSON list of a batch (quotes escaped)
+STORE_ZDICT = (
+    'ALABAMA,ALASKA,ARIZONA,ARKANSAS,CALIFORNIA,COLORADO,CONNECTICUT,DELAWARE,FLORIDA,GEORGIA,HAWAII,'
+    'IDAHO,ILLINOIS,INDIANA,IOWA,KANSAS,KENTUCKY,LOUISIANA,MAINE,MARYLAND,MASSACHUSETTS,MICHIGAN,'
+    'MINNESOTA,MISSISSIPPI,MISSOURI,MONTANA,NEBRASKA,NEVADA,NEW HAMPSHIRE,NEW JERSEY,NEW MEXICO,'
+    'NEW YORK,NORTH CAROLINA,NORTH DAKOTA,OHIO,OKLAHOMA,OREGON,PENNSYLVANIA,RHODE ISLAND,'
+    'SOUTH CAROLINA,SOUTH DAKOTA,TENNESSEE,TEXAS,UTAH,VERMONT,VIRGINIA,WASHINGTON,WEST VIRGINIA,'
+    'WISCONSIN,WYOMING,PUERTO RICO,GULF OF MEXICO,ATLANTIC SOUTH,LAKE MICHIGAN,'
+    'Astronomical Low Tide,Avalanche,Blizzard,Coastal Flood,Cold/Wind Chill,Debris Flow,Dense Fog,'
+    'Dense Smoke,Drought,Dust Devil,Dust Storm,Excessive Heat,Extreme Cold/Wind Chill,Frost/Freeze,'
+    'Funnel Cloud,Freezing Fog,Heat,Heavy Rain,Heavy Snow,High Surf,High Wind,Hurricane (Typhoon),'
+    'Ice Storm,Lake-Effect Snow,Lakeshore Flood,Lightning,Marine Hail,Marine High Wind,'
+    'Marine Strong Wind,Marine Thunderstorm Wind,Rip Current,Seiche,Sleet,Storm Surge/Tide,'
+    'Strong Wind,Tropical Depression,Tropical Storm,Tsunami,Volcanic Ash,Waterspout,Wildfire,'
+    'Winter Storm,Winter Weather,Flash Flood,Flood,Hail,Tornado,Thunderstorm Wind,'
+    'January,February,March,April,May,June,July,August,September,October,November,December,'
+    '\\"EF0\\",\\"EF1\\",\\"F0\\",\\"F1\\",\\"Z\\",\\"M\\",\\"0.00M\\",\\"5.00K\\",\\"1.00K\\",\\"10.00K\\",'
+    '\\",\\"C\\",\\"\\",0,0,0,0,\\"0.00K\\",\\"0.00K\\",\\"\\"", "'
+).encode()
+
+# optional persistent TCP channel to the right neighbour for bulk traffic (stores and
+# replicas during population and rebuilds), negotiated per ring with set-id.
+# control messages always stay on UDP
+BULK_TYPES = ('store', 'store-batch', 'store-replica')
+BULK_QUEUE_SIZE = 1024
+use_bulk_tcp = False
+bulk_queue = queue.Queue(maxsize=BULK_QUEUE_SIZE)
+BULK_RETRY_INTERVAL = 5.0   #seconds before reconnecting to a neighbour we couldn't reach
+bulk_socket = None          #connection to bulk_peer, opened on first use
+bulk_peer = None
+bulk_retry_at = 0.0
+
+# parallel setup: the leader splits the dataset into one line aligned byte range per member
+# and sends each member an ingest-range. Every member reads its range and routes the records
+# itself, then reports ingest-done; the leader sends dht-complete once all ranges are in
+INGEST_TIMEOUT = 30.0       #ranges not reported by then are read by the leader itself
+parallel_ingest = False
+ingest_pending = set()      #members the leader is still waiting on
+ingest_done = threading.Event()
+
+# control plane broadcast: set-id, teardown and the reset-id of a leave go down a tree laid
+# over the members instead of hop by hop around the ring. The tree order is the member list
+# rotated to start at the root; the node at position p forwards the frame as it received it to
+# positions p*F+1 .. p*F+F, and acks its parent once its whole subtree has acked (convergecast).
+# The root hears that an operation is done everywhere after O(log n) hops each way, and the
+# member list travels once per node instead of once per hop
+BROADCAST_FANOUT = 4
+BROADCAST_TIMEOUT = 5.0     #the root gives up waiting after this, each level below waits half as long
+broadcasts = {}             #broadcast-id: {'waiting', 'count', 'parent', 'position', 'deadline', 'on_done'}
+broadcast_counter = itertools.count(1)
+
+# bloom filters (bloom.py): after population the leader collects a filter over the event ids each
+# member holds (owned and replica copies) up the broadcast tree and sends the whole set back down.
+# With them an entry node skips replicas that surely lack an id, and answers not found at once
+# when no replica of the owner can have it, instead of asking one.
+# A filter must never miss an id its member holds, and stores can still be in flight when the leader
+# is done sending, so the leader collects again BLOOM_SETTLE seconds later until the members hold
+# every record and replica it sent out (or BLOOM_ATTEMPTS is reached). Records that were only late
+# and land after a member's filter was built make that member drop its filter ring wide
+# (bloom-drop), so from then on it is never ruled out
+BLOOM_SETTLE = 1.0
+BLOOM_ATTEMPTS = 5
+bloom_filters = {}          #ring identifier: filter as received (dict), decoded on first use
+stale_filters = set()       #members that dropped their filter since the last population
+filter_counts = None        #(records, replicas) our last filter was built over
+bloom_collect = None        #leader only, while collecting: {'records', 'replicas', 'attempt', 'retry_at'}
+dataset_rows = 0            #records the last population sent out
+
+# tracing: this share of the queries, store batches and broadcasts we start is traced across
+# every hop (see tracing.py). 0 turns it off; traces other peers started are always recorded
+trace_sample = 0.0
+trace_log = tracing.TraceLog()
+
+# profile-start / profile-stop from profiling.py, cprofile mode profiles the dispatcher
+profile_control = profiling.ProfileControl()
+
+# failure detection: heartbeat the manager and the right neighbour, who acks.
+# a neighbour that stops acking is reported to the manager and routed around
+HEARTBEAT_INTERVAL = 1.0
+NEIGHBOUR_TIMEOUT = 3.0
+dead_members = set()        #ring identifiers that stopped answering heartbeats
+last_neighbour_ack = 0.0
+queries_handled = 0         #query work done since the last heartbeat, reported to the manager as load
+
+# queries this peer originated and is still waiting on
+# request_id: {'event_id', 'deadline', 'done': threading.Event, 'result'}
+# batch queries hold 'event_ids' instead, and merge the per-owner parts into 'result'
+QUERY_TIMEOUT = 5.0
+QUERY_RETRIES = 2           #a timed out query is retried through a new entry node and replica
+pending_queries = {}
+pending_lock = threading.Lock()
+request_counter = itertools.count(1)
+
+# top-k queries: the k records with the largest value of a field over the whole DHT. The entry node
+# broadcasts a top-k-scan down the tree, every member keeps its k best owned records in a heap and
+# the parts come back up with the acks, so the requester gets at most k records per member and
+# merges them. Records are ranked by (value, event id), so ties are broken the same way everywhere.
+# With threshold passing every node sends its children the highest k-th best rank seen on its path
+# from the root (no record ranked below one member's k-th best can be in the overall top k), and
+# skips the records ranked below it
+# field: columns added up for it, damage is 10.00K / 1.5M style amounts
+TOP_K_FIELDS = {'deaths': (9, 10), 'injuries': (7, 8), 'damage': (11, 12)}
+DAMAGE_UNITS = {'K': 1e3, 'M': 1e6, 'B': 1e9}
+TOP_K_TIMEOUT = QUERY_TIMEOUT + BROADCAST_TIMEOUT   #the scan may wait out a dead subtree
+
 def is_prime(n):
     if n < 2: return False
     if n in (2,3): return True
@@ -137,294 +277,1124 @@ def next_prime_after(n):
         else: n = n + 1
 
 
+def owner_of(event_id):
+    # pos = event id mod s, id = pos mod n
+    position = int(event_id) % table_size
+    return position % ring_size
+
+def event_id_of(entry):
+    # records arrive as raw CSV lines (see dataset_cache), older senders send them as field lists
+    if isinstance(entry, str):
+        return dataset_cache.line_event_id(entry)
+    return int(entry[0])
+
+def store_local(entry):
+    # records we already hold are dropped: the leader reads a range again when its ingest-done
+    # is late or lost, so the same records can arrive twice
+    event_id = event_id_of(entry)
+    if event_id in local_index:
+        return
+    local_table.append(entry)
+    local_index[event_id] = entry
+    record_added()
+
+def replicas_of(owner):
+    # the owner and its next replication_factor successors can all serve the owner's records
+    return [(owner + j) % ring_size for j in range(min(replication_factor, ring_size - 1) + 1)]
+
+def entry_size(entry):
+    # rough JSON size of a record, used to cut batches before they outgrow a datagram
+    if isinstance(entry, str):
+        return len(entry) + 4
+    return sum(len(field) + 4 for field in entry) + 2
+
+def replicate_payload(codec, payload):
+    # copy an encoded batch of records we own onto our successors along the ring
+    if replication_factor > 0 and ring_size > 1:
+        send_right({'status': 'PEER-MESSAGE',
+                    'command-type': 'store-replica',
+                    'codec': codec,
+                    'payload': payload,
+                    'replicas-left': min(replication_factor, ring_size - 1)})
+
+def replicate(entries):
+    if replication_factor == 0 or ring_size < 2:
+        return
+    chunk = []
+    chunk_bytes = 0
+    for entry in entries:
+        chunk.append(entry)
+        chunk_bytes += entry_size(entry)
+        if chunk_bytes >= MAX_STORE_PAYLOAD * 0.8:
+            replicate_payload(store_compression['codec'], encode_entries(chunk, store_compression)[0])
+            chunk = []
+            chunk_bytes = 0
+    if chunk:
+        replicate_payload(store_compression['codec'], encode_entries(chunk, store_compression)[0])
+
+def encode_entries(entries, compression):
+    # store-batch payload: the JSON list of records, compressed and base64'd for the JSON envelope.
+    # uncompressed batches carry the list itself. Returns (payload, raw size, wire size)
+    raw = json.dumps(entries).encode()
+    if compression['codec'] == 'zlib':
+        compressor = zlib.compressobj(compression['level'], zdict=STORE_ZDICT)
+        packed = compressor.compress(raw) + compressor.flush()
+    elif compression['codec'] == 'lzma':
+        # lzma has no preset dictionary support, so it is only worth it for large batches
+        packed = lzma.compress(raw, preset=compression['level'])
+    else:
+        return entries, len(raw), len(raw)
+    payload = base64.b64encode(packed).decode()
+    return payload, len(raw), len(payload)
+
+def decode_entries(codec, payload):
+    if codec == 'zlib':
+        decompressor = zlib.decompressobj(zdict=STORE_ZDICT)
+        raw = decompressor.decompress(base64.b64decode(payload)) + decompressor.flush()
+    elif codec == 'lzma':
+        raw = lzma.decompress(base64.b64decode(payload))
+    else:
+        return payload
+    return json.loads(raw)
+
+def lookup(event_id):
+    # raw lines are split into fields on first access and kept that way
+    index = local_index if event_id in local_index else replica_index
+    record = index.get(event_id)
+    if isinstance(record, str):
+        record = dataset_cache.parse_line(record)
+        index[event_id] = record
+    return record
+
+def member_addr(member_id):
+    return (three_tuple_data[member_id][1], int(three_tuple_data[member_id][2]))
+
+def next_alive_after(member_id):
+    # the first member after member_id on the ring that isn't known to be dead
+    for step in range(1, ring_size):
+        candidate = (member_id + step) % ring_size
+        if candidate not in dead_members:
+            return candidate
+    return member_id
+
+def route_around_dead():
+    # point right_neighbour_tuple at the next live member
+    global right_neighbour_tuple
+    right_neighbour_tuple = three_tuple_data[next_alive_after(identifier)]
+
+def right_neighbour_addr():
+    # member tuples are (peer_name, IPv4_address, p_port)
+    return (right_neighbour_tuple[1], int(right_neighbour_tuple[2]))
+
+def send_raw(payload, addr):
+    # all outbound traffic goes through the send queue so no stage blocks on sendto
+    send_queue.put((payload, addr))
+
+def trace(trace_id, event, **fields):
+    trace_log.record(trace_id, name, identifier, event, **fields)
+
+def ring_ttl():
+    # one walk around the ring
+    return ring_size + 1 if 0 < ring_size < framing.DEFAULT_TTL else framing.DEFAULT_TTL
+
+def send_message(cmd, addr):
+    # peer messages are framed with a routing header, the manager speaks plain JSON.
+    # messages sent while handling a traced message carry its trace id
+    if cmd.get('status') == 'PEER-MESSAGE':
+        target = cmd.get('id', framing.NO_TARGET) if cmd.get('command-type') in ('store', 'store-batch') else framing.NO_TARGET
+        trace_id = tracing.current_trace()
+        if trace_id is not None:
+            trace(trace_id, 'send', type=cmd.get('command-type'), to=f"{addr[0]}:{addr[1]}")
+        send_raw(framing.encode(cmd, target, ring_ttl(), trace_id), addr)
+    else:
+        send_raw(json.dumps(cmd).encode(), addr)
+
+def send_right(cmd):
+    if use_bulk_tcp and cmd.get('command-type') in BULK_TYPES:
+        target = cmd.get('id', framing.NO_TARGET) if cmd.get('command-type') != 'store-replica' else framing.NO_TARGET
+        trace_id = tracing.current_trace()
+        if trace_id is not None:
+            trace(trace_id, 'send', type=cmd.get('command-type'), to='bulk')
+        send_bulk(framing.encode(cmd, target, ring_ttl(), trace_id))
+    else:
+        send_message(cmd, right_neighbour_addr())
+
+def send_bulk(frame):
+    # never waits on a backed up bulk channel: the frame goes over UDP instead, so a slow
+    # neighbour can't stall the receive thread or the dispatcher
+    try:
+        bulk_queue.put_nowait(frame)
+    except queue.Full:
+        send_raw(frame, right_neighbour_addr())
+
+def send_manager(cmd):
+    send_message(cmd, (manager_address, int(manager_port)))
+
+def submit_work(job, *args):
+    # slow local work (file I/O, populating, scans) runs on the worker pool
+    # so the dispatcher can keep draining and forwarding inbound traffic.
+    # Callers usually hold state_lock, which every job takes first, so the job is only held
+    # here and release_work queues it once the lock is free: waiting on a full work_queue with
+    # the lock held would keep the workers from ever draining it
+    if not hasattr(held_work, 'jobs'):
+        held_work.jobs = []
+    held_work.jobs.append((job, args, tracing.current_trace(), time.monotonic()))
+
+def release_work():
+    # without state_lock held: queue the jobs this thread submitted
+    jobs = getattr(held_work, 'jobs', None)
+    while jobs:
+        work_queue.put(jobs.pop(0))
+
 def reciever():
-    global registered, identifier, ring_size, three_tuple_data, local_table, global_table, right_neighbour_tuple, leaving, joining, tearing_down, year_used
+    # receive stage: pulls datagrams off the socket and queues them. Ring traffic for
+    # other nodes is forwarded right here from the routing header, the payload is never decoded
+    # room for bursts of fragments in the kernel while we catch up
+    peer_socket.setsockopt(s.SOL_SOCKET, s.SO_RCVBUF, framing.SOCKET_BUFFER_SIZE)
+    buf = bytearray(framing.RECV_BUFFER_SIZE)
+    view = memoryview(buf)
     while True:
-        # waiting for a response from the manager. 
-        # if the recieved message isn't from  manager, ignore
-        raw_data, recv_addr = peer_socket.recvfrom(4096)
-        # if(data):
-        #     print(f"\n[From {recv_addr[0]}:{recv_addr[1]}] {data.decode()}")
-        data = json.loads(raw_data.decode())
-        if data.get('status') != 'PEER-MESSAGE':
-            print("Status:"+data.get('status'))
-
-        #handle response from the manager
-        if data.get('status') == 'SUCCESS':
-            if data.get('command-type') == 'register':
-                registered = True
-
-            elif data.get('command-type') == 'setup-dht':
-                # setting id for all the registered peers
-                identifier = 0
-                three_tuple_data = data.get('members')
-                
-                c = three_tuple_data.copy()
-                for index in range(0, len(data)-1):
-                    c[index].append(index)
-
-
-                for index in range(1, len(data)-1):
-                    #getting address and port for peer index # x
-                    _, peerx_add, peerx_port, _ = data.get('members')[index]
-                    #encoding data using json and sending to peers_i
-                    cmd = {
-                        'status': 'PEER-MESSAGE',
-                        'command-type': 'set-id', 
-                        'identifier': index, 
-                        'ring_size': data.get('size'), 
-                        '3-tuple-data': (data.get('members'))}
-                    print(cmd)
-                    cmd_json = json.dumps(cmd).encode()
-                    peer_socket.sendto(cmd_json, (peerx_add, int(peerx_port)))
-                ring_size = data.get('size')
-                right_neighbour_index = (identifier+1) % ring_size 
-                right_neighbour_tuple = data.get('members')[right_neighbour_index]
-                
-                print(three_tuple_data)
-                populate_dht()
-                # change later, set csv value as 1950
-                # reading csv file
-                with open("./CSVFiles/details-" + str(year_used) + ".csv", "r") as file:
-                    reader = csv.reader(file)
-                    next(reader)
-
-                    # local table has i = 1,..., l entries
-                    for row in reader:
-                        global_table.append(tuple(row))
-                    
-                for entry in global_table:
-                    position = int(entry[0]) % next_prime_after(2*len(local_table))
-                    id = position % ring_size
-                    if id == identifier:
-                        local_table.append(entry)
-                    else:
-                        cmd = {
-                            'status': 'PEER-MESSAGE',
-                            'command-type': 'store',
-                            'id': id,
-                            'entry': entry
-                        }
-                        cmd_json = json.dumps(cmd).encode()
-                        right_name, right_add, right_port, _ = right_neighbour_tuple
-                        peer_socket.sendto(cmd_json, (right_add, right_port))
-                
-                print(len(local_table))
-
-                cmd = {'command': 'dht-complete', 
-                        'peer_name': name}
-                cmd_json = json.dumps(cmd).encode()
-                peer_socket.sendto(cmd_json,(manager_address, int(manager_port)))
-
-            elif data.get('command-type') == 'teardown-dht':
-                #confirmed, start teardown
-                tearing_down = True
-                cmd = {
-                    'status': 'PEER-MESSAGE',
-                    'command-type': 'teardown'}
-                cmd_json = json.dumps(cmd).encode()
-                right_name, right_add, right_port, _ = right_neighbour_tuple
-                peer_socket.sendto(cmd_json, (right_add, right_port))
-
-            elif data.get('command-type') == 'query-dht':
-                print(f"{raw_data.decode()}")
-                event_id = 10120412
+        nbytes, recv_addr = peer_socket.recvfrom_into(buf)
+        # one copy out of the shared receive buffer, everything after works on views of it
+        accept_frame(memoryview(bytearray(view[:nbytes])), recv_addr)
+
+def accept_frame(raw_data, recv_addr):
+    # shared by the UDP receive loop and the TCP bulk readers
+    if framing.is_frame(raw_data):
+        type_code, target, _, _, _ = framing.read_header(raw_data)
+        trace_id = framing.trace_id(raw_data)
+        if trace_id is not None:
+            trace(trace_id, 'recv', type=framing.TYPE_NAMES.get(type_code), source=f"{recv_addr[0]}:{recv_addr[1]}")
+        if type_code in framing.ROUTED_TYPES and target != framing.NO_TARGET and target != identifier:
+            ttl = framing.decrement_ttl(raw_data)
+            if ttl > 0:
+                if use_bulk_tcp:
+                    send_bulk(raw_data)
+                else:
+                    send_raw(raw_data, right_neighbour_addr())
+            if trace_id is not None:
+                trace(trace_id, 'forward', type=framing.TYPE_NAMES.get(type_code), target=target, ttl=ttl)
+            return
+    inbound_queue.put((raw_data, recv_addr, time.monotonic()))
+
+def bulk_listener():
+    # accept bulk connections from our left neighbour on the same address as the UDP socket
+    listener = s.socket(s.AF_INET, s.SOCK_STREAM)
+    listener.setsockopt(s.SOL_SOCKET, s.SO_REUSEADDR, 1)
+    listener.bind(peer_socket.getsockname())
+    listener.listen()
+    while True:
+        conn, conn_addr = listener.accept()
+        threading.Thread(target=bulk_reader, args=(conn, conn_addr), daemon=True).start()
+
+def bulk_reader(conn, conn_addr):
+    try:
+        while True:
+            frame = framing.read_stream(conn)
+            if frame is None:
+                break
+            accept_frame(memoryview(frame), conn_addr)
+    except (OSError, ValueError) as e:
+        print(f"Bulk channel from {conn_addr[0]}:{conn_addr[1]} closed: {e}")
+    finally:
+        conn.close()
+
+def bulk_sender():
+    # writes bulk frames to the right neighbour over TCP, reconnecting when the neighbour
+    # changes and falling back to UDP if it can't be reached. After a failed connection the
+    # same neighbour is only tried again BULK_RETRY_INTERVAL later, until then frames go over UDP
+    global bulk_socket, bulk_peer, bulk_retry_at
+    while True:
+        frame = bulk_queue.get()
+        addr = right_neighbour_addr()
+        if bulk_socket is None and bulk_peer == addr and time.monotonic() < bulk_retry_at:
+            send_raw(frame, addr)
+            continue
+        try:
+            if bulk_socket is None or bulk_peer != addr:
+                if bulk_socket is not None:
+                    bulk_socket.close()
+                bulk_socket = None
+                # the timeout stays on for writes, a stuck neighbour fails over to UDP like a dead one
+                bulk_socket = s.create_connection(addr, timeout=NEIGHBOUR_TIMEOUT)
+                bulk_peer = addr
+            framing.write_stream(bulk_socket, frame)
+        except OSError as e:
+            print(f"Bulk channel to {addr[0]}:{addr[1]} failed, using UDP: {e}")
+            if bulk_socket is not None:
+                bulk_socket.close()
+            bulk_socket = None
+            bulk_peer = addr
+            bulk_retry_at = time.monotonic() + BULK_RETRY_INTERVAL
+            send_raw(frame, addr)
+
+def dispatcher():
+    # dispatch stage: decodes messages and handles them, handing slow work to the worker pool
+    while True:
+        dispatch(*inbound_queue.get())
+
+def dispatch(raw_data, recv_addr, received):
+    # one inbound message, also called directly by the simulator
+    try:
+        if framing.is_fragment(raw_data):
+            raw_data = reassembler.add(raw_data, recv_addr)
+            if raw_data is None:
+                return
+        data = framing.decode_datagram(raw_data)
+    except ValueError:
+        print(f"Dropping malformed message from {recv_addr[0]}:{recv_addr[1]}")
+        return
+    if data.get('command') in profiling.PROFILE_COMMANDS:
+        send_message(profile_control.handle(data, name), recv_addr)
+        return
+
+    trace_id = framing.trace_id(raw_data)
+    tracing.set_current(trace_id)
+    if trace_id is not None:
+        trace(trace_id, 'dispatch', type=data.get('command-type'), queue_wait=time.monotonic() - received)
+    try:
+        with state_lock:
+            handle_message(data, raw_data, recv_addr)
+    except Exception as e:
+        print(f"Error handling {data.get('command-type')}: {e}")
+    release_work()
+    tracing.set_current(None)
+
+def worker():
+    while True:
+        run_job(*work_queue.get())
+
+def run_job(job, args, trace_id, queued):
+    tracing.set_current(trace_id)
+    if trace_id is not None:
+        trace(trace_id, 'work', type=job.__name__, queue_wait=time.monotonic() - queued)
+    try:
+        job(*args)
+    except Exception as e:
+        print(f"Error in worker: {e}")
+    release_work()
+    tracing.set_current(None)
+
+def sender():
+    # send stage: the only place that writes to the socket
+    while True:
+        payload, addr = send_queue.get()
+        try:
+            for datagram in framing.split(payload):
+                peer_socket.sendto(datagram, addr)
+        except OSError as e:
+            print(f"Send to {addr[0]}:{addr[1]} failed: {e}")
+
+def start_pipeline():
+    global pipeline_started
+    if pipeline_started:
+        return
+    pipeline_started = True
+    threads = [threading.Thread(target=reciever, daemon=True),
+               threading.Thread(target=dispatcher, daemon=True),
+               threading.Thread(target=sender, daemon=True)]
+    threads += [threading.Thread(target=worker, daemon=True) for _ in range(WORKER_COUNT)]
+    threads.append(threading.Thread(target=query_sweeper, daemon=True))
+    threads.append(threading.Thread(target=heartbeater, daemon=True))
+    threads.append(threading.Thread(target=bulk_listener, daemon=True))
+    threads.append(threading.Thread(target=bulk_sender, daemon=True))
+    for thread in threads:
+        thread.start()
+
+def heartbeater():
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        heartbeat_tick()
+        release_work()
+
+def heartbeat_tick():
+    global last_neighbour_ack, queries_handled
+    if registered:
+        # our load rides along, the manager uses it to pick entry nodes for queries
+        with state_lock:
+            load = {'queued': inbound_queue.qsize() + work_queue.qsize(),
+                    'queries': queries_handled / HEARTBEAT_INTERVAL}
+            queries_handled = 0
+        send_manager({'command': 'heartbeat',
+                      'peer_name': name,
+                      'load': load})
+    with state_lock:
+        expire_broadcasts()
+        retry_filters()
+        if identifier < 0 or ring_size < 2 or not three_tuple_data:
+            return
+        now = time.monotonic()
+        if last_neighbour_ack == 0.0:
+            last_neighbour_ack = now
+        if now - last_neighbour_ack > NEIGHBOUR_TIMEOUT:
+            suspect = next_alive_after(identifier)
+            if suspect != identifier:
+                print(f"Right neighbour {three_tuple_data[suspect][0]} stopped answering heartbeats")
+                dead_members.add(suspect)
+                send_manager({'command': 'suspect-peer',
+                              'peer_name': name,
+                              'suspect': three_tuple_data[suspect][0]})
+                route_around_dead()
+            last_neighbour_ack = now
+        heartbeat = {'status': 'PEER-MESSAGE',
+                     'command-type': 'heartbeat',
+                     'identifier': identifier}
+        send_right(heartbeat)
+        successor = (identifier + 1) % ring_size
+        if successor in dead_members:
+            # keep probing our real successor so we notice when it comes back
+            send_message(heartbeat, member_addr(successor))
+
+def adopt_membership(members):
+    # with state_lock held: take our identifier and neighbours from a member list
+    global identifier, ring_size, three_tuple_data, right_neighbour_tuple, last_neighbour_ack
+    three_tuple_data = [tuple(member) for member in members]
+    ring_size = len(three_tuple_data)
+    identifier = [member[0] for member in three_tuple_data].index(name)
+    right_neighbour_tuple = three_tuple_data[(identifier + 1) % ring_size]
+    dead_members.clear()
+    last_neighbour_ack = 0.0
+    print("Identifier: " + str(identifier))
+    print("Ring_size: " + str(ring_size))
+
+def tree_order(data):
+    # the node list a broadcast is laid over, root first. A root that is not a member
+    # (a peer that is leaving) is put in front of the members
+    members = data.get('members') or three_tuple_data
+    root = data.get('root')
+    if root < 0:
+        return [data.get('initiator')] + list(members)
+    return list(members[root:]) + list(members[:root])
+
+def tree_children(position, size):
+    first = position * BROADCAST_FANOUT + 1
+    return list(range(first, min(first + BROADCAST_FANOUT, size)))
+
+def tree_depth(position):
+    depth = 0
+    while position > 0:
+        position = (position - 1) // BROADCAST_FANOUT
+        depth += 1
+    return depth
+
+def start_broadcast(cmd, root, on_done, initiator=None, collected=None):
+    # with state_lock held, on the root, after it has applied cmd itself.
+    # on_done(count) runs once every node has acked, count includes the root.
+    # collected, if given, is the root's part of what the acks carry back up (see relay_broadcast)
+    cmd['broadcast-id'] = f"{name}-{next(broadcast_counter)}"
+    cmd['root'] = root
+    if initiator is not None:
+        cmd['initiator'] = initiator
+    trace_id = tracing.current_trace() or tracing.sample(trace_sample)
+    if trace_id is not None:
+        trace(trace_id, 'start', type=cmd.get('command-type'), broadcast=cmd['broadcast-id'])
+    relay_broadcast(cmd, framing.encode(cmd, trace_id=trace_id), None, on_done, collected)
+
+def relay_broadcast(data, raw_data, parent, on_done=None, collected=None):
+    # with state_lock held: pass a broadcast on to our children and wait for their acks.
+    # collected is this node's part of a convergecast, a dict the acks merge the subtree's parts
+    # into on the way up. The root's on_done finds them all in the dict it passed in
+    order = tree_order(data)
+    position = [member[0] for member in order].index(name)
+    children = tree_children(position, len(order))
+    entry = {'waiting': set(children),
+             'count': 1,
+             'parent': parent,
+             'position': position,
+             'deadline': time.monotonic() + BROADCAST_TIMEOUT / 2 ** tree_depth(position),
+             'on_done': on_done,
+             'collected': collected if collected is not None else {}}
+    broadcasts[data.get('broadcast-id')] = entry
+    for child in children:
+        send_raw(raw_data, (order[child][1], int(order[child][2])))
+    if not children:
+        finish_broadcast(data.get('broadcast-id'))
+
+def broadcast_ack(data):
+    # with state_lock held
+    entry = broadcasts.get(data.get('broadcast-id'))
+    if entry is None or data.get('position') not in entry['waiting']:
+        return
+    entry['waiting'].discard(data.get('position'))
+    entry['count'] += data.get('count')
+    entry['collected'].update(data.get('collected') or {})
+    if not entry['waiting']:
+        finish_broadcast(data.get('broadcast-id'))
+
+def finish_broadcast(broadcast_id):
+    entry = broadcasts.pop(broadcast_id)
+    if entry['parent'] is not None:
+        ack = {'status': 'PEER-MESSAGE',
+               'command-type': 'broadcast-ack',
+               'broadcast-id': broadcast_id,
+               'position': entry['position'],
+               'count': entry['count']}
+        if entry['collected']:
+            ack['collected'] = entry['collected']
+        send_message(ack, entry['parent'])
+    else:
+        entry['on_done'](entry['count'])
+
+def expire_broadcasts():
+    # with state_lock held: subtrees that never acked (a member died) are given up on,
+    # so the rest of the operation still completes
+    now = time.monotonic()
+    for broadcast_id in [b for b, entry in broadcasts.items() if entry['deadline'] < now]:
+        print(f"Broadcast {broadcast_id}: no ack from tree positions {sorted(broadcasts[broadcast_id]['waiting'])}")
+        finish_broadcast(broadcast_id)
+
+def clear_tables():
+    global bloom_collect
+    local_table.clear()
+    local_index.clear()
+    replica_index.clear()
+    bloom_filters.clear()
+    stale_filters.clear()
+    bloom_collect = None
+
+def own_filter():
+    # this member's part of a bloom-collect
+    global filter_counts
+    filter_counts = (len(local_index), len(replica_index))
+    return {'filter': bloom.build(itertools.chain(local_index, replica_index)).encode(),
+            'records': len(local_index),
+            'replicas': len(replica_index)}
+
+def holds_maybe(member, event_id):
+    # with state_lock held: False only when member's filter says it surely doesn't hold event_id
+    bloom_filter = bloom_filters.get(member)
+    if bloom_filter is None:
+        return True
+    if isinstance(bloom_filter, dict):
+        bloom_filter = bloom.decode(bloom_filter)
+        bloom_filters[member] = bloom_filter
+    return event_id in bloom_filter
+
+def share_filters():
+    # with state_lock held, on the leader once it has sent out a population
+    global bloom_collect
+    bloom_collect = {'records': dataset_rows,
+                     'replicas': dataset_rows * min(replication_factor, ring_size - 1),
+                     'attempt': 0,
+                     'retry_at': None}
+    collect_filters()
+
+def collect_filters():
+    bloom_collect['attempt'] += 1
+    bloom_collect['retry_at'] = None
+    # parts are keyed by identifier as a string, which is how they come out of JSON
+    collected = {str(identifier): own_filter()}
+    start_broadcast({'status': 'PEER-MESSAGE',
+                     'command-type': 'bloom-collect'}, identifier,
+                    lambda count: filters_collected(collected), collected=collected)
+
+def filters_collected(collected):
+    # the root of a bloom-collect: share the filters, or try again once the stores had time to land
+    global bloom_collect
+    records = sum(part['records'] for part in collected.values())
+    replicas = sum(part['replicas'] for part in collected.values())
+    print(f"Bloom filters from {len(collected)} of {ring_size} members: {records} records, {replicas} replicas")
+    if bloom_collect is None:
+        # the tables were cleared in the meantime
+        return
+    if (records < bloom_collect['records'] or replicas < bloom_collect['replicas']) and bloom_collect['attempt'] < BLOOM_ATTEMPTS:
+        bloom_collect['retry_at'] = time.monotonic() + BLOOM_SETTLE
+        return
+    bloom_collect = None
+    # the filters go out as their own trace, not as part of the collect
+    tracing.set_current(None)
+    # members that didn't answer have no filter, and so are never ruled out
+    filters = {member: part['filter'] for member, part in collected.items()}
+    adopt_filters(filters)
+    start_broadcast({'status': 'PEER-MESSAGE',
+                     'command-type': 'bloom-filters',
+                     'filters': filters}, identifier, filters_shared)
+
+def retry_filters():
+    # with state_lock held, from the heartbeat
+    if bloom_collect is not None and bloom_collect['retry_at'] is not None and bloom_collect['retry_at'] <= time.monotonic():
+        collect_filters()
+
+def adopt_filters(filters):
+    bloom_filters.clear()
+    bloom_filters.update({int(member): encoded for member, encoded in filters.items() if int(member) not in stale_filters})
+    if identifier in bloom_filters and (len(local_index), len(replica_index)) != filter_counts:
+        # records landed between building our filter and getting it back
+        drop_own_filter()
+
+def record_added():
+    # with state_lock held, after storing a record or replica we didn't hold yet
+    if identifier in bloom_filters:
+        drop_own_filter()
+
+def drop_own_filter():
+    # our filter may miss what we took in since it was built, so no member may rule us out with it
+    print("Records arrived after our bloom filter was shared, dropping it")
+    stale_filters.add(identifier)
+    bloom_filters.pop(identifier, None)
+    start_broadcast({'status': 'PEER-MESSAGE',
+                     'command-type': 'bloom-drop',
+                     'member': identifier}, identifier, filter_dropped)
+
+def filter_dropped(count):
+    print(f"Bloom filter dropped on {count} of {ring_size} members")
+
+def filters_shared(count):
+    print(f"Bloom filters reached {count} of {ring_size} members")
+
+def set_id_done(count):
+    print(f"set-id reached {count} of {ring_size} members")
+    # population is traced per store batch, not as part of the set-id trace
+    tracing.set_current(None)
+    submit_work(setup_populate)
+
+def teardown_done(count):
+    # the root of a teardown broadcast, every member has dropped its tables
+    print(f"teardown reached {count} of {ring_size} members")
+    if tearing_down:
+        send_manager({'command': 'teardown-complete',
+                      'dht': dht_name,
+                      'peer_name': name})
+    elif leaving:
+        #step 1 of leave-dht is done, renumber the remaining members: our right
+        #neighbour becomes the new leader
+        remaining = three_tuple_data[identifier + 1:] + three_tuple_data[:identifier]
+        start_broadcast({'status': 'PEER-MESSAGE',
+                         'command-type': 'reset-id',
+                         'cause': 'leave',
+                         'members': remaining}, -1, leave_reset_done, three_tuple_data[identifier])
+    elif joining:
+        #step 2 of join-dht is done
+        #begin rebuilding dht and send rebuilt signal to manager
+        submit_work(rebuild_populate, name)
+
+def leave_reset_done(count):
+    #step 2 of leave-dht is done, the new leader rebuilds
+    leader = three_tuple_data[(identifier + 1) % ring_size]
+    send_message({'status': 'PEER-MESSAGE',
+                  'command-type': 'rebuild-dht',
+                  'initiator-name': name}, (leader[1], int(leader[2])))
+
+def setup_populate():
+    # runs on a worker: populate the DHT, then tell the manager we're done
+    if parallel_ingest:
+        populate_parallel()
+    else:
+        populate_dht()
+    with state_lock:
+        print(len(local_table))
+    send_manager({'command': 'dht-complete',
+                  'dht': dht_name,
+                  'peer_name': name})
+    with state_lock:
+        share_filters()
+
+def rebuild_populate(initiator_name):
+    populate_dht()
+    #send rebuilt signal to manager
+    send_manager({'command': 'dht-rebuilt',
+                  'dht': dht_name,
+                  'new-leader': name,
+                  'peer_name': initiator_name})
+    with state_lock:
+        share_filters()
+
+def find_event(data):
+    # runs on a worker: answer the query if this node holds the event id (as owner or replica),
+    # otherwise pass it on to a random replica of the owner so reads spread over all copies.
+    # Replicas whose bloom filter rules the id out are skipped, and if that rules out all of
+    # them the answer is not found right here. The result always goes straight back to the originator
+    global queries_handled
+    event_id = int(data.get('event_id'))
+    id_seq = data.get('id-seq')
+    with state_lock:
+        queries_handled += 1
+        id_seq.append(identifier)
+        replicas = replicas_of(owner_of(event_id)) if table_size else [identifier]
+        record = lookup(event_id)
+        candidates = [i for i in replicas if i not in id_seq and i not in dead_members]
+        holders = [i for i in replicas if holds_maybe(i, event_id)]
+        if record is not None or identifier in replicas or not candidates or not holders:
+            reply = {'status': 'PEER-MESSAGE',
+                     'command-type': 'find-event-result',
+                     'request-id': data.get('request-id'),
+                     'event_id': event_id,
+                     'found': record is not None,
+                     'record': record,
+                     'id-seq': id_seq}
+            send_message(reply, tuple(data.get('origin')))
+            return
+        next_id = random.choice([i for i in candidates if i in holders] or candidates)
+        next_addr = (three_tuple_data[next_id][1], int(three_tuple_data[next_id][2]))
+    data['id-seq'] = id_seq
+    send_message(data, next_addr)
+
+def find_event_result(data):
+    with pending_lock:
+        query = pending_queries.pop(data.get('request-id'), None)
+    if query is None:
+        # the query already timed out
+        return
+    query['result'] = data
+    query['done'].set()
+    if query['trace'] is not None:
+        trace(query['trace'], 'done', type='find-event', found=data.get('found'), hops=len(data.get('id-seq')))
+    if data.get('found'):
+        print(f"Storm event found {data.get('event_id')}")
+        print(f"Id-seq: {data.get('id-seq')}")
+        print(f"Record: {data.get('record')}")
+    else:
+        print(f"Storm event {data.get('event_id')} not found in the DHT.")
+
+def find_events(data):
+    # runs on the entry node of a batch lookup: group the ids by owning node
+    # and send a single sub-request for each group to one of that owner's replicas.
+    # Ids the bloom filters rule out for every replica of their owner are reported
+    # missing by us, as one more part. So are all ids if we never got a store and can't
+    # work out owners, and an empty batch is answered right away as one empty part
+    global queries_handled
+    groups = {}
+    pruned = []
+    with state_lock:
+        queries_handled += 1
+        for event_id in data.get('event_ids'):
+            owner = owner_of(event_id) if table_size else None
+            if owner is not None and any(holds_maybe(replica, int(event_id)) for replica in replicas_of(owner)):
+                groups.setdefault(owner, []).append(int(event_id))
+            else:
+                pruned.append(int(event_id))
+        targets = {owner: random.choice([r for r in replicas_of(owner) if r not in dead_members] or replicas_of(owner)) for owner in groups}
+        target_addrs = {owner: (three_tuple_data[t][1], int(three_tuple_data[t][2])) for owner, t in targets.items()}
+    answer_here = bool(pruned) or not groups
+    parts = len(groups) + (1 if answer_here else 0)
+    if answer_here:
+        send_message({'status': 'PEER-MESSAGE',
+                      'command-type': 'find-events-result',
+                      'request-id': data.get('request-id'),
+                      'attempt': data.get('attempt'),
+                      'found': {},
+                      'missing': pruned,
+                      'parts': parts},
+                     tuple(data.get('origin')))
+    for owner, event_ids in groups.items():
+        part = {'status': 'PEER-MESSAGE',
+                'command-type': 'find-events-part',
+                'request-id': data.get('request-id'),
+                'attempt': data.get('attempt'),
+                'origin': data.get('origin'),
+                'event_ids': event_ids,
+                'parts': parts}
+        if targets[owner] == identifier:
+            find_events_part(part)
+        else:
+            send_message(part, target_addrs[owner])
+
+def find_events_part(data):
+    # owner side of a batch lookup, answers the originator with what it has
+    global queries_handled
+    found = {}
+    missing = []
+    with state_lock:
+        queries_handled += 1
+        for event_id in data.get('event_ids'):
+            record = lookup(event_id)
+            if record is None:
+                missing.append(event_id)
+            else:
+                found[event_id] = record
+    send_message({'status': 'PEER-MESSAGE',
+                  'command-type': 'find-events-result',
+                  'request-id': data.get('request-id'),
+                  'attempt': data.get('attempt'),
+                  'found': found,
+                  'missing': missing,
+                  'parts': data.get('parts')},
+                 tuple(data.get('origin')))
+
+def find_events_result(data):
+    # merge one owner's part into the batch, the batch is done when every part is in
+    with pending_lock:
+        query = pending_queries.get(data.get('request-id'))
+        if query is None or query['attempt'] != data.get('attempt'):
+            # timed out, or a late part from an attempt we already retried
+            return
+        result = query['result']
+        result['found'].update({int(k): v for k, v in data.get('found').items()})
+        result['missing'].extend(data.get('missing'))
+        result['parts-received'] += 1
+        if result['parts-received'] < data.get('parts'):
+            return
+        del pending_queries[data.get('request-id')]
+    query['done'].set()
+    if query['trace'] is not None:
+        trace(query['trace'], 'done', type='find-events', found=len(result['found']), missing=len(result['missing']))
+    print(f"Batch {data.get('request-id')}: {len(result['found'])} found, {len(result['missing'])} missing")
+    if result['missing']:
+        print(f"Missing: {sorted(result['missing'])}")
+
+def damage_amount(text):
+    # "10.00K" -> 10000.0, empty or unreadable -> 0
+    text = text.strip()
+    if not text:
+        return 0.0
+    unit = DAMAGE_UNITS.get(text[-1].upper())
+    try:
+        return float(text[:-1]) * unit if unit else float(text)
+    except ValueError:
+        return 0.0
+
+def field_value(record, field):
+    total = 0
+    for column in TOP_K_FIELDS[field]:
+        text = record[column] if column < len(record) else ''
+        if field == 'damage':
+            total += damage_amount(text)
+        else:
+            total += int(text) if text.strip().isdigit() else 0
+    return total
+
+def local_top_k(field, k, threshold):
+    # with state_lock held: our k best owned records as [value, event id, record], best first.
+    # Replica copies are left out so every record is counted once
+    best = []
+    threshold = tuple(threshold) if threshold is not None else None
+    for event_id in list(local_index):
+        record = lookup(event_id)
+        value = field_value(record, field)
+        if threshold is not None and (value, event_id) < threshold:
+            continue
+        if len(best) < k:
+            heapq.heappush(best, (value, event_id, record))
+        elif (value, event_id) > best[0][:2]:
+            heapq.heapreplace(best, (value, event_id, record))
+    return [list(entry) for entry in sorted(best, key=lambda entry: entry[:2], reverse=True)]
+
+def passed_threshold(threshold, part, k):
+    # the threshold for our children, [value, event id]: ours, or the rank of our k-th best if that is higher
+    if len(part) < k:
+        return threshold
+    kth = part[-1][:2]
+    return kth if threshold is None else max(list(threshold), kth)
+
+def top_k_start(data):
+    # runs on a worker of the entry node, which becomes the root of the scan
+    k = data.get('k')
+    with state_lock:
+        part = local_top_k(data.get('field'), k, None)
+        threshold = passed_threshold(None, part, k) if data.get('threshold-passing') else None
+        collected = {str(identifier): part}
+        start_broadcast({'status': 'PEER-MESSAGE',
+                         'command-type': 'top-k-scan',
+                         'request-id': data.get('request-id'),
+                         'field': data.get('field'),
+                         'k': k,
+                         'threshold-passing': bool(data.get('threshold-passing')),
+                         'threshold': threshold}, identifier,
+                        lambda count: top_k_done(data, collected, count), collected=collected)
+
+def top_k_scan(data, raw_data, recv_addr):
+    # runs on a worker: add our part and pass the scan on, with a raised threshold if we have one
+    k = data.get('k')
+    threshold = data.get('threshold')
+    with state_lock:
+        part = local_top_k(data.get('field'), k, threshold)
+        # a node that holds k records raises the threshold even if nobody above it could
+        if data.get('threshold-passing') and passed_threshold(threshold, part, k) != threshold:
+            data['threshold'] = passed_threshold(threshold, part, k)
+            raw_data = framing.encode(data, trace_id=framing.trace_id(raw_data))
+        relay_broadcast(data, raw_data, recv_addr, collected={str(identifier): part})
+
+def top_k_done(request, collected, count):
+    # the root of a top-k-scan, every member's part is in
+    send_message({'status': 'PEER-MESSAGE',
+                  'command-type': 'top-k-result',
+                  'request-id': request.get('request-id'),
+                  'attempt': request.get('attempt'),
+                  'parts': collected,
+                  'members': count}, tuple(request.get('origin')))
+
+def top_k_result(data):
+    # requester side: merge the per member parts
+    with pending_lock:
+        query = pending_queries.get(data.get('request-id'))
+        if query is None or query['attempt'] != data.get('attempt'):
+            return
+        del pending_queries[data.get('request-id')]
+    candidates = [entry for part in data.get('parts').values() for entry in part]
+    best = heapq.nlargest(query['top-k']['k'], candidates, key=lambda entry: (entry[0], entry[1]))
+    query['result'] = {'records': best, 'members': data.get('members'), 'candidates': len(candidates)}
+    query['done'].set()
+    if query['trace'] is not None:
+        trace(query['trace'], 'done', type='top-k', members=data.get('members'), candidates=len(candidates))
+    print(f"Top {query['top-k']['k']} by {query['top-k']['field']} from {data.get('members')} members ({len(candidates)} candidates):")
+    for value, event_id, record in best:
+        print(f"  {value:g}  {event_id}  {record}")
+
+def query_sweeper():
+    while True:
+        time.sleep(0.5)
+        sweep_queries()
+
+def sweep_queries():
+    # retry queries that never got an answer through a fresh entry node (and so usually
+    # a different replica), and give up on them once the retries are used up
+    now = time.monotonic()
+    retries = []
+    expired = []
+    with pending_lock:
+        for request_id in [rid for rid, q in pending_queries.items() if q['deadline'] < now]:
+            query = pending_queries[request_id]
+            if query['attempt'] < QUERY_RETRIES:
+                query['attempt'] += 1
+                query['deadline'] = now + query.get('timeout', QUERY_TIMEOUT)
+                if 'event_ids' in query:
+                    query['result'] = {'found': {}, 'missing': [], 'parts-received': 0}
+                retries.append(query['request'])
+            else:
+                expired.append((request_id, pending_queries.pop(request_id)))
+    for request in retries:
+        send_manager(request)
+    for request_id, query in expired:
+        query['done'].set()
+        print(f"Query {request_id} for {query.get('event_id', query.get('event_ids', query.get('top-k')))} timed out")
+
+def handle_message(data, raw_data, recv_addr):
+    # called by the dispatcher with state_lock held
+    global registered, identifier, ring_size, three_tuple_data, local_table, global_table, right_neighbour_tuple, leaving, joining, tearing_down, year_used, table_size, dht_name, replication_factor, last_neighbour_ack, store_compression, use_bulk_tcp
+    if data.get('command-type') in ('heartbeat', 'suspect-peer') and data.get('status') == 'SUCCESS':
+        # the manager acknowledging liveness traffic
+        return
+    if data.get('status') != 'PEER-MESSAGE':
+        print("Status:"+data.get('status'))
+
+    #handle response from the manager
+    if data.get('status') == 'SUCCESS':
+        if data.get('command-type') == 'register':
+            registered = True
+
+        elif data.get('command-type') == 'setup-dht':
+            # setting id for all the registered peers, each member finds its identifier
+            # by its position in the member list. We populate once every member has it
+            dht_name = data.get('dht', DEFAULT_DHT)
+            adopt_membership(data.get('members'))
+            start_broadcast({'status': 'PEER-MESSAGE',
+                             'command-type': 'set-id',
+                             'dht': dht_name,
+                             'replication': replication_factor,
+                             'compression': store_compression,
+                             'bulk-tcp': use_bulk_tcp,
+                             'members': three_tuple_data}, identifier, set_id_done)
+            print(three_tuple_data)
+
+        elif data.get('command-type') == 'teardown-dht':
+            #confirmed, start teardown
+            tearing_down = True
+            clear_tables()
+            start_broadcast({'status': 'PEER-MESSAGE',
+                             'command-type': 'teardown'}, identifier, teardown_done)
+
+        elif data.get('command-type') == 'query-dht':
+            # the manager gave us an entry node for one of our pending queries
+            with pending_lock:
+                query = pending_queries.get(data.get('request-id'))
+            if query is None:
+                return
+            if 'top-k' in query:
+                cmd = {'status': 'PEER-MESSAGE',
+                       'command-type': 'top-k',
+                       'request-id': data.get('request-id'),
+                       'attempt': query['attempt'],
+                       'origin': peer_socket.getsockname(),
+                       'field': query['top-k']['field'],
+                       'k': query['top-k']['k'],
+                       'threshold-passing': query['top-k']['threshold-passing']}
+            elif 'event_ids' in query:
+                cmd = {'status': 'PEER-MESSAGE',
+                       'command-type': 'find-events',
+                       'request-id': data.get('request-id'),
+                       'attempt': query['attempt'],
+                       'origin': peer_socket.getsockname(),
+                       'event_ids': query['event_ids']}
+            else:
                 cmd = {'status': 'PEER-MESSAGE',
-                       'command-type': 'find-event', 
-                       'event_id': event_id,
+                       'command-type': 'find-event',
+                       'request-id': data.get('request-id'),
+                       'origin': peer_socket.getsockname(),
+                       'event_id': query['event_id'],
                        'id-seq': []}
-                cmd_json = json.dumps(cmd).encode()
-                peer_socket.sendto(cmd_json, (data.get("addr"), int(data.get("p-port"))))
-
-
-            elif data.get('command-type') == 'leave-dht':
-                leaving = True
-                #initiate step 1
-                cmd = {
-                    'status': 'PEER-MESSAGE',
-                    'command-type': 'teardown',
-                    'cause': 'leave'}
-                cmd_json = json.dumps(cmd).encode()
-                right_name, right_add, right_port = right_neighbour_tuple
-                peer_socket.sendto(cmd_json, (right_add, right_port))
-
-            elif data.get('command-type') == 'join-dht':
-                leaving = True
-                identifier = 0
-                right_neighbour_tuple = data.get('leader')
-                # initiate step 1
-                cmd = {
-                    'status': 'PEER-MESSAGE',
-                    'command-type': 'reset-id',
-                    'identifier': 1,
-                    'cause': 'join',
-                    'initiator': (name, peer_socket.getsockname()[0], peer_socket.getsockname()[1])}
-                cmd_json = json.dumps(cmd).encode()
-                right_name, right_add, right_port = right_neighbour_tuple
-                peer_socket.sendto(cmd_json, (right_add, right_port))
-                
-            elif data.get('command-type') == 'dht-complete':
-                pass
-
-        elif data.get('status') == "FAILURE":
-            print(data.get('message'))
-            if data.get('command-type') == 'setup-dht':
-                print(data.get('members'))
+            if query['trace'] is not None:
+                tracing.set_current(query['trace'])
+                trace(query['trace'], 'start', type=cmd['command-type'], request=data.get('request-id'),
+                      attempt=query['attempt'], entry=data.get('peer-name'))
+            send_message(cmd, (data.get("addr"), int(data.get("p-port"))))
+
+        elif data.get('command-type') == 'leave-dht':
+            leaving = True
+            #initiate step 1
+            clear_tables()
+            start_broadcast({'status': 'PEER-MESSAGE',
+                             'command-type': 'teardown',
+                             'cause': 'leave'}, identifier, teardown_done)
+
+        elif data.get('command-type') == 'join-dht':
+            joining = True
+            identifier = 0
+            right_neighbour_tuple = data.get('leader')
+            # initiate step 1
+            send_right({
+                'status': 'PEER-MESSAGE',
+                'command-type': 'reset-id',
+                'identifier': 1,
+                'cause': 'join',
+                'initiator': (name, peer_socket.getsockname()[0], peer_socket.getsockname()[1])})
+
+        elif data.get('command-type') == 'dht-complete':
             pass
-        elif data.get('status') == 'PEER-MESSAGE':
-            if data.get('command-type')== 'set-id':
+
+    elif data.get('status') == "FAILURE":
+        print(data.get('message'))
+        if data.get('request-id') is not None and data.get('message') != 'overloaded':
+            # the manager turned down one of our queries. An overloaded manager didn't look at
+            # it at all, so it stays pending and query_sweeper retries it after the timeout
+            with pending_lock:
+                query = pending_queries.pop(data.get('request-id'), None)
+            if query is not None:
+                query['done'].set()
+        if data.get('command-type') == 'setup-dht':
+            print(data.get('members'))
+        pass
+    elif data.get('status') == 'PEER-MESSAGE':
+        if data.get('command-type')== 'set-id':
+            dht_name = data.get('dht', DEFAULT_DHT)
+            replication_factor = data.get('replication', 0)
+            store_compression = data.get('compression', {'codec': 'none', 'level': 6})
+            use_bulk_tcp = data.get('bulk-tcp', False)
+            adopt_membership(data.get('members'))
+            print(three_tuple_data)
+            relay_broadcast(data, raw_data, recv_addr)
+        elif data.get('command-type')== 'store':
+            # the dispatcher already forwarded stores meant for other nodes
+            store_local(data.get('entry'))
+            year_used = data.get('year')
+            table_size = data.get('table-size')
+            replicate([data.get('entry')])
+
+        elif data.get('command-type')== 'store-batch':
+            entries = decode_entries(data.get('codec'), data.get('payload'))
+            for entry in entries:
+                store_local(entry)
+            year_used = data.get('year')
+            table_size = data.get('table-size')
+            replicate_payload(data.get('codec'), data.get('payload'))
+
+        elif data.get('command-type')== 'heartbeat':
+            send_message({'status': 'PEER-MESSAGE',
+                          'command-type': 'heartbeat-ack',
+                          'identifier': identifier}, recv_addr)
+
+        elif data.get('command-type')== 'heartbeat-ack':
+            if data.get('identifier') in dead_members:
+                # a member we had given up on is back
+                dead_members.discard(data.get('identifier'))
+                route_around_dead()
+            last_neighbour_ack = time.monotonic()
+
+        elif data.get('command-type')== 'store-replica':
+            for entry in decode_entries(data.get('codec'), data.get('payload')):
+                event_id = event_id_of(entry)
+                if event_id not in replica_index:
+                    replica_index[event_id] = entry
+                    record_added()
+            if data.get('replicas-left') > 1:
+                data['replicas-left'] -= 1
+                send_right(data)
+
+        elif data.get('command-type')== 'find-event':
+            submit_work(find_event, data)
+
+        elif data.get('command-type')== 'ingest-range':
+            submit_work(ingest_range, data)
+
+        elif data.get('command-type')== 'ingest-done':
+            ingest_finished(data)
+
+        elif data.get('command-type')== 'find-event-result':
+            find_event_result(data)
+
+        elif data.get('command-type')== 'find-events':
+            submit_work(find_events, data)
+
+        elif data.get('command-type')== 'find-events-part':
+            submit_work(find_events_part, data)
+
+        elif data.get('command-type')== 'find-events-result':
+            find_events_result(data)
+
+        elif data.get('command-type')== 'teardown':
+            #delete own hash table
+            clear_tables()
+            relay_broadcast(data, raw_data, recv_addr)
+
+        elif data.get('command-type')== 'broadcast-ack':
+            broadcast_ack(data)
+
+        elif data.get('command-type')== 'top-k':
+            submit_work(top_k_start, data)
+
+        elif data.get('command-type')== 'top-k-scan':
+            submit_work(top_k_scan, data, raw_data, recv_addr)
+
+        elif data.get('command-type')== 'top-k-result':
+            top_k_result(data)
+
+        elif data.get('command-type')== 'bloom-collect':
+            relay_broadcast(data, raw_data, recv_addr, collected={str(identifier): own_filter()})
+
+        elif data.get('command-type')== 'bloom-filters':
+            adopt_filters(data.get('filters'))
+            relay_broadcast(data, raw_data, recv_addr)
+
+        elif data.get('command-type')== 'bloom-drop':
+            stale_filters.add(data.get('member'))
+            bloom_filters.pop(data.get('member'), None)
+            relay_broadcast(data, raw_data, recv_addr)
+
+        elif data.get('command-type') == 'reset-id' and 'broadcast-id' in data:
+            #a member left, take the new numbering
+            adopt_membership(data.get('members'))
+            relay_broadcast(data, raw_data, recv_addr)
+
+        elif data.get('command-type') == 'reset-id':
+            # a joining peer only knows the leader, so its reset-id still goes around the
+            # ring and collects the new member list on the way back to it
+            if joining:
+                #step 1 of join-dht is done
+                adopt_membership(data.get('members'))
+                #initiate step 2
+                clear_tables()
+                start_broadcast({'status': 'PEER-MESSAGE',
+                                 'command-type': 'teardown',
+                                 'cause': 'join'}, identifier, teardown_done)
+            else:
+                #reset id, add the initiator as the new first member & forward
+                three_tuple_data = [tuple(data.get('initiator'))] + list(three_tuple_data)
+                ring_size += 1
                 identifier = data.get('identifier')
-                print("Identifier: " +str(identifier))
-                ring_size = data.get('ring_size')
-                print("Ring_size: " +str(ring_size))
-                
-                # finding and storing the 3-tuple of its right neighbour
-                right_neighbour_index = (identifier+1) % ring_size 
-                print("right_neighbour_index: " +str(right_neighbour_index))
-
-                right_neighbour_tuple = data.get('3-tuple-data')[right_neighbour_index]
-                three_tuple_data = data.get('3-tuple-data')
-
-                print(three_tuple_data)
-            elif data.get('command-type')== 'store':
-                #add data to local table if it's the intended recipient
-                if data.get('id') == identifier:
-                    local_table.append(data.get('entry'))
-                    year_used = data.get('year')
-                #forward to neighbor if not
-                else:
-                    right_name, right_add, right_port, _ = right_neighbour_tuple
-                    peer_socket.sendto(raw_data, (right_add, right_port))
-                print(len(local_table))
-
-            elif data.get('command-type')== 'find-event':
-                print("finding EVENT\n")
-                id_seq = data.get('id-seq')
-                I = [i for i in range(0, ring_size)]
-                print(id_seq)
-                position = data.get('event_id') % next_prime_after(2*len(local_table))
-                id = position % ring_size
-                
-                # not hash, just lookup: fix later
-                if id == identifier:
-                    for i in local_table: 
-                        if int(data.get('event_id')) == int(i[7]):
-                            print(f"Storm event found {data.get('event_id')}")
-                            print("Id-seq\n")
-                            print(id_seq)
-                            print("Record\n")
-                            print(local_table)
-                            return
-                
-                print("Not found")
-                id_seq.append(identifier)
-                updateI = [i for i in I if i not in id_seq]
-                if (len(updateI) == 0):
-                    print(f"Storm event {data.get('event_id')} not found in the DHT.")
-                    return
-                nextI = random.choice(updateI)
-                cmd = {'status': 'PEER-MESSAGE',
-                        'command-type': 'find-event', 
-                        'event_id': data.get('event_id'),
-                        'id-seq': id_seq}
-                cmd_json = json.dumps(cmd).encode()
-                peer_socket.sendto(cmd_json, (three_tuple_data[nextI][1], int((three_tuple_data[nextI][2]))))
-
-            elif data.get('command-type')== 'teardown':
-                #delete own hash table
-                local_table.clear()
-                if not leaving and not joining and not tearing_down:
-                    #forward to neighbor if this peer did not initiate the teardown
-                    right_name, right_add, right_port, _ = right_neighbour_tuple
-                    peer_socket.sendto(raw_data, (right_add, right_port))
-                elif tearing_down:
-                    #done with teardown
-                    cmd = {'command': 'teardown-complete',
-                            'peer_name': name}
-                    cmd_json = json.dumps(cmd).encode()
-                    peer_socket.sendto(cmd_json,(manager_address, int(manager_port)))
-                elif leaving:
-                    #step 1 of leave-dht is done
-                    #send out the reset-id
-                    cmd = {'status': 'PEER-MESSAGE',
-                            'command-type': 'reset-id',
-                            'identifier': 0,
-                            'cause': 'leave'}
-                    cmd_json = json.dumps(cmd).encode()
-                    right_name, right_add, right_port = right_neighbour_tuple
-                    peer_socket.sendto(cmd_json, (right_add, right_port))
-                elif joining:
-                    #step 2 of join-dht is done
-                    #begin rebuilding dht
-                    populate_dht()
-                    #send rebuilt signal to manager
-                    cmd = {'command': 'dht-rebuilt',
-                            'new-leader': name,
-                            'peer_name': name}
-                    cmd_json = json.dumps(cmd).encode()
-                    peer_socket.sendto(cmd_json,(manager_address, int(manager_port)))
-
-            elif data.get('command-type') == 'reset-id':
-                if leaving:
-                    #step 2 of leave-dht is done
-                    #send out rebuild-dht
-                    cmd = {'status': 'PEER-MESSAGE',
-                            'command-type': 'rebuild-dht',
-                            'initiator-name': name}
-                    cmd_json = json.dumps(cmd).encode()
-                    right_name, right_add, right_port = right_neighbour_tuple
-                    peer_socket.sendto(cmd_json, (right_add, right_port))
-                elif joining:
-                    ring_size = data.get('identifier')
-                    #step 1 of join-dht is done
-                    #initiate step 2
-                    cmd = {'status': 'PEER-MESSAGE',
-                           'command-type': 'teardown'}
-                    cmd_json = json.dumps(cmd).encode()
-                    right_name, right_add, right_port = right_neighbour_tuple
-                    peer_socket.sendto(cmd_json, (right_add, right_port))
-                else:
-                    #reset id, rearrange peers, & forward
-                    new_id = data.get('identifier')
-                    #rearrange peers
-                    temp_d = deque(three_tuple_data)
-                    temp_d.rotate(identifier-new_id)
-                    if data.get('cause') == 'leave':
-                        # remove last element if a peer is leaving
-                        temp_d.pop()
-                        # and change ring size to match
-                        ring_size -= 1
-                    if data.get('cause') == 'join':
-                        ring_size += 1
-                        #right neighbor is initiator if you are the last one
-                        if identifier == len(temp_d):
-                            right_neighbour_tuple = data.get('initiator')
-                        #add initiator to member array as first
-                        temp_d.appendleft(data.get('initiator'))
-                    three_tuple_data = list(temp_d)
-
-                    identifier = new_id
-                    cmd = {'status': 'PEER-MESSAGE',
+                #right neighbor is initiator if you are the last one
+                right_neighbour_tuple = three_tuple_data[(identifier + 1) % ring_size]
+                send_right({'status': 'PEER-MESSAGE',
                             'command-type': 'reset-id',
                             'identifier': identifier+1,
-                            'cause': data.get('cause')}
-                    cmd_json = json.dumps(cmd).encode()
-                    right_name, right_add, right_port = right_neighbour_tuple
-                    peer_socket.sendto(cmd_json, (right_add, right_port))
+                            'cause': data.get('cause'),
+                            'initiator': data.get('initiator'),
+                            'members': three_tuple_data})
 
-            elif data.get('command-type') == 'rebuild-dht':
-                populate_dht()
-                #send rebuilt signal to manager
-                cmd = {'command': 'dht-rebuilt',
-                        'new-leader': name,
-                        'peer_name': data.get('initiator-name')}
-                cmd_json = json.dumps(cmd).encode()
-                peer_socket.sendto(cmd_json,(manager_address, int(manager_port)))
+        elif data.get('command-type') == 'rebuild-dht':
+            submit_work(rebuild_populate, data.get('initiator-name'))
 
-
-        else:
-            print("Manager responded with an unrecognized command. Try again.")
-            print(data)
+    else:
+        print("Manager responded with an unrecognized command. Try again.")
+        print(data)
 
 def register(name, addr, m_port, p_port):
     time.sleep(1)
@@ -443,74 +1413,257 @@ def register(name, addr, m_port, p_port):
     cmd_json = json.dumps(cmd).encode()
     # m_socket.bind((addr, m_port))
     peer_socket.sendto(cmd_json, (manager_address, int(manager_port)))
-    t.start()
+    start_pipeline()
 
-def dht_setup(name, size, year):
-    global year_used
+def dht_setup(name, size, year, dht=DEFAULT_DHT, replicas=0, codec='none', level=6, bulk_tcp=False, parallel=False):
+    global year_used, replication_factor, store_compression, use_bulk_tcp, parallel_ingest
     #encoding data using json and sending to manager
     year_used = year
+    replication_factor = replicas
+    store_compression = {'codec': codec, 'level': level}
+    use_bulk_tcp = bulk_tcp
+    parallel_ingest = parallel
     cmd = {'command': 'setup-dht', 
             'peer_name': name, 
             'n': size, 
-            'YYYY': year}
+            'YYYY': year,
+            'dht': dht}
     cmd_json = json.dumps(cmd).encode()
     peer_socket.sendto(cmd_json,(manager_address, int(manager_port)))
 
-def query_dht(peer_name):
-    #encoding data using json and sending to manager
-    cmd = {'command': 'query-dht', 
-            'peer_name': peer_name}
-    cmd_json = json.dumps(cmd).encode()
-    peer_socket.sendto(cmd_json,(manager_address, int(manager_port)))
+def query_dht(peer_name, event_ids, dht=DEFAULT_DHT):
+    # one query per event id, each with its own request id so any number can be in flight.
+    # the manager echoes the request id with the entry node, the owner replies to us directly
+    request_ids = []
+    for event_id in event_ids:
+        request_id = f"{name}-{next(request_counter)}"
+        request = {'command': 'query-dht',
+                   'peer_name': peer_name,
+                   'dht': dht,
+                   'request-id': request_id}
+        with pending_lock:
+            pending_queries[request_id] = {'event_id': int(event_id),
+                                           'request': request,
+                                           'trace': tracing.sample(trace_sample),
+                                           'attempt': 0,
+                                           'deadline': time.monotonic() + QUERY_TIMEOUT,
+                                           'done': threading.Event(),
+                                           'result': None}
+        send_manager(request)
+        request_ids.append(request_id)
+    return request_ids
+
+def find_events_batch(peer_name, event_ids, dht=DEFAULT_DHT):
+    # one manager round trip and one sub-request per owning node for the whole batch,
+    # the result is {'found': {event_id: record}, 'missing': [event_id]}
+    request_id = f"{name}-{next(request_counter)}"
+    request = {'command': 'query-dht',
+               'peer_name': peer_name,
+               'dht': dht,
+               'request-id': request_id}
+    with pending_lock:
+        pending_queries[request_id] = {'event_ids': [int(e) for e in event_ids],
+                                       'request': request,
+                                       'trace': tracing.sample(trace_sample),
+                                       'attempt': 0,
+                                       'deadline': time.monotonic() + QUERY_TIMEOUT,
+                                       'done': threading.Event(),
+                                       'result': {'found': {}, 'missing': [], 'parts-received': 0}}
+    send_manager(request)
+    return request_id
+
+def top_k(peer_name, field, k, threshold_passing=False, dht=DEFAULT_DHT):
+    # the k records with the largest field value over the DHT, result is
+    # {'records': [[value, event id, record]], 'members', 'candidates'}
+    if field not in TOP_K_FIELDS:
+        print(f"Unknown field {field}, use one of {', '.join(TOP_K_FIELDS)}")
+        return None
+    request_id = f"{name}-{next(request_counter)}"
+    request = {'command': 'query-dht',
+               'peer_name': peer_name,
+               'dht': dht,
+               'request-id': request_id}
+    with pending_lock:
+        pending_queries[request_id] = {'top-k': {'field': field, 'k': k, 'threshold-passing': threshold_passing},
+                                       'request': request,
+                                       'trace': tracing.sample(trace_sample),
+                                       'attempt': 0,
+                                       'timeout': TOP_K_TIMEOUT,
+                                       'deadline': time.monotonic() + TOP_K_TIMEOUT,
+                                       'done': threading.Event(),
+                                       'result': None}
+    send_manager(request)
+    return request_id
+
+def wait_for_queries(request_ids, timeout=QUERY_TIMEOUT):
+    # block until every query has an answer or has timed out, returns request_id: result
+    results = {}
+    with pending_lock:
+        queries = {rid: pending_queries.get(rid) for rid in request_ids}
+    for request_id, query in queries.items():
+        if query is not None:
+            query['done'].wait(timeout)
+            results[request_id] = query['result']
+    return results
 
 def teardown_dht():
     cmd = {'command': 'teardown-dht',
-           'peer_name': name}
+           'peer_name': name,
+           'dht': dht_name}
     cmd_json = json.dumps(cmd).encode()
     peer_socket.sendto(cmd_json,(manager_address, int(manager_port)))
 
 def leave_dht():
     cmd = {'command': 'leave-dht',
-           'peer_name': name}
+           'peer_name': name,
+           'dht': dht_name}
     cmd_json = json.dumps(cmd).encode()
     peer_socket.sendto(cmd_json,(manager_address, int(manager_port)))
 
 def join_dht():
     cmd = {'command': 'join-dht',
-           'peer_name': name}
+           'peer_name': name,
+           'dht': dht_name}
     cmd_json = json.dumps(cmd).encode()
     peer_socket.sendto(cmd_json,(manager_address, int(manager_port)))
 
-def populate_dht():
-    global year_used, global_table, local_table, right_neighbour_tuple
-    # reading csv file
-    with open("./CSVFiles/details-" + str(year_used) + ".csv", "r") as file:
-        reader = csv.reader(file)
-        next(reader)
-
-        # local table has i = 1,..., l entries
-        for row in reader:
-            global_table.append(tuple(row))
-
-    for entry in global_table:
-        position = int(entry[0]) % next_prime_after(2 * len(local_table))
-        id = position % ring_size
+def route_records(records, compression):
+    # records: (owner, entry) pairs. Entries we own are stored here, the rest are grouped per
+    # owner and sent as one store-batch per group once the group would fill a datagram.
+    # The raw budget tracks the compression ratio seen so far. Returns (our entries, counters)
+    batches = {}
+    batch_bytes = {}
+    ratio = 1.0
+    sent = {'batches': 0, 'raw': 0, 'wire': 0}
+
+    def flush(owner):
+        nonlocal ratio
+        entries = batches.pop(owner)
+        batch_bytes.pop(owner)
+        payload, raw_len, wire_len = encode_entries(entries, compression)
+        ratio = max(1.0, raw_len / max(1, wire_len))
+        sent['batches'] += 1
+        sent['raw'] += raw_len
+        sent['wire'] += wire_len
+        trace_id = tracing.sample(trace_sample)
+        if trace_id is not None:
+            tracing.set_current(trace_id)
+            trace(trace_id, 'start', type='store-batch', owner=owner, records=len(entries))
+        send_right({
+            'status': 'PEER-MESSAGE',
+            'command-type': 'store-batch',
+            'id': owner,
+            'codec': compression['codec'],
+            'payload': payload,
+            'year': year_used,
+            'table-size': table_size
+        })
+        tracing.set_current(parent_trace)
+
+    parent_trace = tracing.current_trace()
+    local_entries = []
+    for id, entry in records:
         if id == identifier:
-            local_table.append(entry)
-        else:
-            cmd = {
-                'status': 'PEER-MESSAGE',
-                'command-type': 'store',
-                'id': id,
-                'entry': entry,
-                'year': year_used
-            }
-            cmd_json = json.dumps(cmd).encode()
-            right_name, right_add, right_port = right_neighbour_tuple
-            peer_socket.sendto(cmd_json, (right_add, right_port))
+            local_entries.append(entry)
+            continue
+        batches.setdefault(id, []).append(entry)
+        batch_bytes[id] = batch_bytes.get(id, 0) + entry_size(entry)
+        if batch_bytes[id] * 1.25 >= MAX_STORE_PAYLOAD * ratio:
+            flush(id)
+    for owner in list(batches):
+        flush(owner)
+    with state_lock:
+        for entry in local_entries:
+            store_local(entry)
+    return local_entries, sent
+
+def populate_dht():
+    global year_used, global_table, local_table, right_neighbour_tuple, table_size, dataset_rows
+    # records come from the binary dataset cache, which is built from the csv file the first
+    # time a year is used and already has every record's owner worked out for this ring size
+    with state_lock:
+        members = ring_size
+    dataset = dataset_cache.get(year_used, members)
+    global_table = dataset.records
+
+    with state_lock:
+        table_size = dataset.table_size
+        dataset_rows = len(dataset.records)
+        compression = dict(store_compression)
+
+    records = ((id, global_table[row]) for id, rows in enumerate(dataset.partition(members)) for row in rows)
+    local_entries, sent = route_records(records, compression)
+    replicate(local_entries)
+    print(f"Sent {sent['batches']} store batches, {sent['raw']} bytes of records as {sent['wire']} bytes ({compression['codec']})")
+
+def populate_parallel():
+    # runs on the leader's worker: hand every member a byte range of the dataset, read our own,
+    # then wait until every member has reported its range done
+    global table_size, dataset_rows
+    with state_lock:
+        members = ring_size
+        year = year_used
+    rows, ranges = dataset_cache.plan_ranges(year, members)
+    with state_lock:
+        table_size = next_prime_after(2 * rows)
+        dataset_rows = rows
+        ingest_pending.clear()
+        ingest_pending.update(range(members))
+        ingest_done.clear()
+        compression = dict(store_compression)
+    requests = [{'status': 'PEER-MESSAGE',
+                 'command-type': 'ingest-range',
+                 'member': member,
+                 'year': year,
+                 'table-size': table_size,
+                 'compression': compression,
+                 'start': start,
+                 'end': end,
+                 'origin': peer_socket.getsockname()} for member, (start, end) in enumerate(ranges)]
+    for member, request in enumerate(requests):
+        if member != identifier:
+            send_message(request, member_addr(member))
+    ingest_range(requests[identifier])
+    if not ingest_done.wait(INGEST_TIMEOUT):
+        with state_lock:
+            missing = sorted(ingest_pending)
+        # members that were only slow have stored these records already, owners drop the copies
+        print(f"No ingest-done from members {missing}, reading their ranges here")
+        for member in missing:
+            ingest_range(requests[member])
+    print(f"Parallel ingest of {rows} records over {members} members done")
+
+def ingest_range(data):
+    # runs on a worker: read one byte range of the dataset, route its records, report to the leader
+    global year_used, table_size
+    with state_lock:
+        year_used = data.get('year')
+        table_size = data.get('table-size')
+        members = ring_size
+    lines, event_ids = dataset_cache.scan_range(year_used, data.get('start'), data.get('end'))
+    records = (((event_id % table_size) % members, line) for event_id, line in zip(event_ids, lines))
+    local_entries, sent = route_records(records, data.get('compression'))
+    replicate(local_entries)
+    report = {'status': 'PEER-MESSAGE',
+              'command-type': 'ingest-done',
+              'member': data.get('member'),
+              'rows': len(lines),
+              'batches': sent['batches']}
+    if tuple(data.get('origin')) == peer_socket.getsockname():
+        with state_lock:
+            ingest_finished(report)
+    else:
+        send_message(report, tuple(data.get('origin')))
+
+def ingest_finished(data):
+    # leader side, with state_lock held
+    ingest_pending.discard(data.get('member'))
+    print(f"Range {data.get('member')} done: {data.get('rows')} records in {data.get('batches')} batches")
+    if not ingest_pending:
+        ingest_done.set()
 
 def main():
-    global name
+    global name, trace_sample
     # Start a new thread where peer listens to incoming messages. 
     # Main Loop where user inputs commands and parameters
     # Main Loop can be exited by using "exit" or "CTRL+C"
@@ -566,6 +1719,7 @@ def main():
                         addr = input("IP address: ")
                         m_port = input("Peer-manager port: ")
                         p_port = input("Peer-Peer port: ")
+                        peer_socket.bind((addr, int(p_port)))
                     register(name, addr, int(m_port), int(p_port))
 
                 case "setup-dht":
@@ -573,14 +1727,39 @@ def main():
                     # year = input("Year: ")
                     n = 3
                     year = 1950
-                    dht_setup(name, int(n), int(year))
+                    dht = input("DHT name: ") or DEFAULT_DHT
+                    replicas = input("Replicas: ") or 0
+                    codec = input("Compression (none/zlib/lzma): ") or 'none'
+                    level = input("Compression level: ") or 6
+                    bulk_tcp = input("Bulk TCP channel (y/n): ").lower() == 'y'
+                    parallel = input("Parallel ingest (y/n): ").lower() == 'y'
+                    dht_setup(name, int(n), int(year), dht, int(replicas), codec, int(level), bulk_tcp, parallel)
 
                 case "teardown-dht":
                     teardown_dht()
 
+                case "trace":
+                    trace_sample = float(input("Trace sample rate (0-1): ") or 0)
+
                 case "query-dht":
                     peer_name = input("Peer name: ")
-                    query_dht(peer_name)
+                    dht = input("DHT name: ") or DEFAULT_DHT
+                    event_ids = input("Event ids: ").split()
+                    query_dht(peer_name, event_ids, dht)
+
+                case "find-events":
+                    peer_name = input("Peer name: ")
+                    dht = input("DHT name: ") or DEFAULT_DHT
+                    event_ids = input("Event ids: ").split()
+                    find_events_batch(peer_name, event_ids, dht)
+
+                case "top-k":
+                    peer_name = input("Peer name: ")
+                    dht = input("DHT name: ") or DEFAULT_DHT
+                    field = input(f"Field ({'/'.join(TOP_K_FIELDS)}): ") or 'deaths'
+                    k = input("k: ") or 10
+                    threshold_passing = input("Threshold passing (y/n): ").lower() == 'y'
+                    top_k(peer_name, field, int(k), threshold_passing, dht)
 
                 case "leave-dht":
                     leave_dht()
@@ -603,7 +1782,5 @@ if __name__ == "__main__":
     manager_port = 15000
     # else: manager_port = input("Enter manager_port: ")
     # print("\n")
-    t = threading.Thread(target=reciever)
-
 
     main()
@@ -0,0 +1,181 @@
+# on demand profiling of a running manager or peer
+# both accept two control commands over their normal UDP socket:
+#   {'command': 'profile-start', 'mode': 'sampling' | 'cprofile', 'interval': seconds}
+#   {'command': 'profile-stop'}
+# profile-stop writes the results to ./profiles/ on the profiled host and answers with the file names
+#
+# 'sampling' (the default) looks at the stacks of every thread every interval seconds, so it sees the
+# whole pipeline (receive, dispatch, workers, send) at a small fixed cost. It writes
+# <name>-<time>.collapsed (one 'outer;...;inner count' line per stack, for flame graph tools) and
+# <name>-<time>.txt (functions with the most samples)
+# 'cprofile' traces every call with cProfile, but only in the thread that handled profile-start:
+# the manager's serving loop (handle_message) or a peer's dispatcher (decoding and handle_message).
+# It writes <name>-<time>.prof (pstats) and <name>-<time>.txt
+#
+# client:
+#   python profiling.py start 127.0.0.1:15000 --mode cprofile
+#   python profiling.py stop 127.0.0.1:15000
+#   python profiling.py report profiles/manager-20240101-120000.prof
+
+import os
+import io
+import sys
+import json
+import time
+import socket
+import pstats
+import cProfile
+import argparse
+import threading
+from collections import Counter
+
+PROFILE_DIRECTORY = './profiles'
+PROFILE_COMMANDS = ('profile-start', 'profile-stop')
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 40
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+# samples the stacks of all other threads from a background thread
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter() # (outermost frame, ..., innermost frame): samples
+        self.samples = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                self.stacks[tuple(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def dump(self, base):
+        with open(base + '.collapsed', 'w') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(';'.join(stack) + f" {count}\n")
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        stack_samples = sum(self.stacks.values()) or 1
+        with open(base + '.txt', 'w') as file:
+            file.write(f"{self.samples} samples every {self.interval * 1000.0:.1f} ms, {stack_samples} thread stacks\n\n")
+            file.write("most samples in the function itself:\n")
+            for function, count in own.most_common(TOP_FUNCTIONS):
+                file.write(f"{100.0 * count / stack_samples:6.2f}%  {count:8}  {function}\n")
+            file.write("\nmost samples in the function or below it:\n")
+            for function, count in total.most_common(TOP_FUNCTIONS):
+                file.write(f"{100.0 * count / stack_samples:6.2f}%  {count:8}  {function}\n")
+        return [base + '.collapsed', base + '.txt']
+
+class CallProfiler:
+# cProfile on the thread that starts it; stop must be called from that thread too
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def dump(self, base):
+        self.profile.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w') as file:
+            file.write(summary(base + '.prof'))
+        return [base + '.prof', base + '.txt']
+
+def summary(prof_path):
+    out = io.StringIO()
+    stats = pstats.Stats(prof_path, stream=out)
+    stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+    stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+    return out.getvalue()
+
+class ProfileControl:
+# what the manager and the peers call with a profile-start or profile-stop message
+    def __init__(self, directory=PROFILE_DIRECTORY):
+        self.directory = directory
+        self.active = None
+        self.started = 0.0
+
+    def handle(self, message, name):
+        command = message.get('command')
+        if command == 'profile-start':
+            if self.active is not None:
+                return {'status': 'FAILURE', 'message': 'Profiler already running', 'command-type': command}
+            mode = message.get('mode') or 'sampling'
+            if mode == 'sampling':
+                self.active = SamplingProfiler(float(message.get('interval') or SAMPLE_INTERVAL))
+            elif mode == 'cprofile':
+                self.active = CallProfiler()
+            else:
+                return {'status': 'FAILURE', 'message': f'Unknown profiler mode {mode}', 'command-type': command}
+            self.active.start()
+            self.started = time.monotonic()
+            print(f"Profiling started ({mode})")
+            return {'status': 'SUCCESS', 'message': f'Profiling started ({mode})', 'command-type': command}
+        if self.active is None:
+            return {'status': 'FAILURE', 'message': 'Profiler not running', 'command-type': command}
+        profiler = self.active
+        self.active = None
+        profiler.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{name or 'process'}-{time.strftime('%Y%m%d-%H%M%S')}")
+        files = profiler.dump(base)
+        print(f"Profile written to {', '.join(files)}")
+        return {'status': 'SUCCESS', 'message': f'Profiled {time.monotonic() - self.started:.1f}s',
+                'command-type': command, 'files': files}
+
+def main():
+    parser = argparse.ArgumentParser(description='Start or stop the profiler of a running manager or peer')
+    parser.add_argument('action', choices=['start', 'stop', 'report'])
+    parser.add_argument('target', help='ip:port of the manager or the peer (its p_port), or a .prof file for report')
+    parser.add_argument('--mode', choices=['sampling', 'cprofile'], default='sampling')
+    parser.add_argument('--interval', type=float, default=SAMPLE_INTERVAL, help='seconds between samples')
+    parser.add_argument('--timeout', type=float, default=10.0)
+    args = parser.parse_args()
+    if args.action == 'report':
+        print(summary(args.target))
+        return
+    ip, port = args.target.rsplit(':', 1)
+    request = {'command': 'profile-' + args.action}
+    if args.action == 'start':
+        request.update({'mode': args.mode, 'interval': args.interval})
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(args.timeout)
+    sock.sendto(json.dumps(request).encode(), (ip, int(port)))
+    try:
+        data, _ = sock.recvfrom(65535)
+    except socket.timeout:
+        print(f"No response from {args.target}")
+        sys.exit(1)
+    response = json.loads(data.decode())
+    print(f"{response.get('status')}: {response.get('message')}")
+    for path in response.get('files', []):
+        print(f"  {path}")
+
+if __name__ == "__main__":
+    main()
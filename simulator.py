@@ -0,0 +1,595 @@
+# discrete event simulator for the DHT protocol
+# runs the real manager logic (Manager.handle_message) and the real peer message handlers from
+# peer.py for thousands of virtual nodes inside one process, over a virtual network with latency,
+# jitter, loss and reordering. Nothing binds a socket and no threads are started
+#
+# peer.py keeps a node's state in module globals, so every virtual node owns its own copy of those
+# globals (node_state) and they are swapped into the module while that node runs. peer.send_raw and
+# the node's peer_socket hand messages to the virtual network, peer.time and manager.time read the
+# simulated clock. A delivered message goes through accept_frame and dispatch like a received
+# datagram, and the work it queues runs right after it on the same node
+#
+# messages are delivered whole. Loss is per datagram, a message that would go out as k fragments is
+# lost if any of them is. Every node and the manager handle one message at a time and each message
+# costs them --service-time, so queueing shows up in the completion times. Parallel ingest and the
+# bulk TCP channel are not modelled
+#
+# the scenario: register --nodes peers, setup-dht over all of them, --queries lookups from --clients
+# other peers, top-k queries over every field with and without threshold passing (--top-k), crash
+# --churn members (found through heartbeats) and run the lookups again, then teardown-dht. Every operation is traced (tracing.py), which gives hops and messages per store
+# batch, broadcast and query
+#
+#   python simulator.py --nodes 1000 --rows 20000 --queries 2000 --churn 20
+#   python simulator.py --nodes 200 --year 1950 --replicas 2 --loss 0.01 --jitter 0.005 --reorder 0.05
+
+import os
+import sys
+import json
+import heapq
+import random
+import argparse
+import itertools
+import threading
+from collections import Counter
+
+import framing
+import dataset_cache
+import loadgen
+import manager
+import peer
+
+MANAGER_ADDR = ('127.0.0.1', 15000)
+PORT_BASE = 20000           #node i gets m_port PORT_BASE + 2i and p_port PORT_BASE + 2i + 1
+REGISTER_ATTEMPTS = 3
+REGISTER_TIMEOUT = 1.0
+QUERY_SWEEP_INTERVAL = 0.5
+QUERY_CHECK_INTERVAL = 0.1
+
+STATES = ['ALABAMA', 'ARIZONA', 'CALIFORNIA', 'FLORIDA', 'GEORGIA', 'IOWA', 'KANSAS', 'MISSOURI',
+          'NEBRASKA', 'OHIO', 'OKLAHOMA', 'TEXAS', 'VIRGINIA', 'WISCONSIN']
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September',
+          'October', 'November', 'December']
+EVENT_TYPES = ['Hail', 'Thunderstorm Wind', 'Tornado', 'Flash Flood', 'Flood', 'Heavy Snow', 'High Wind']
+
+class SimClock:
+# stands in for the time module in peer.py and manager.py
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        pass
+
+class VirtualSocket:
+# a node's peer_socket: its address, and sendto into the virtual network
+    def __init__(self, sim, addr):
+        self.sim = sim
+        self.addr = addr
+
+    def getsockname(self):
+        return self.addr
+
+    def sendto(self, data, addr):
+        self.sim.send(data, addr)
+
+class Recorder:
+# takes the place of peer.trace_log: per trace counts instead of trace files
+    def __init__(self, clock):
+        self.clock = clock
+        self.traces = {} # trace id: {'type', 'start', 'last', 'done', 'messages', 'forwards', 'expired', 'hops', 'attempts'}
+
+    def record(self, trace_id, name, node, event, **fields):
+        now = self.clock.now
+        entry = self.traces.get(trace_id)
+        if entry is None:
+            entry = {'type': fields.get('type'), 'start': now, 'last': now, 'done': None,
+                     'messages': 0, 'forwards': 0, 'expired': 0, 'hops': None, 'attempts': 1}
+            self.traces[trace_id] = entry
+        entry['last'] = now
+        if event == 'start':
+            entry['attempts'] = max(entry['attempts'], fields.get('attempt', 0) + 1)
+        elif event == 'recv':
+            entry['messages'] += 1
+        elif event == 'forward':
+            if fields.get('ttl') > 0:
+                entry['forwards'] += 1
+            else:
+                entry['expired'] += 1
+        elif event == 'done':
+            entry['done'] = now
+            entry['hops'] = fields.get('hops')
+
+class Node:
+    def __init__(self, index, name, addr, m_port, state):
+        self.index = index
+        self.name = name
+        self.addr = addr
+        self.m_port = m_port
+        self.state = state          #peer.py globals of this node while it isn't running
+        self.alive = True
+        self.client = False
+        self.busy_until = 0.0
+        self.handled = 0
+
+def node_name(index):
+    # peer names must be alphabetic
+    return 'sim' + loadgen.peer_name_for(index)[2:]
+
+def synthetic_dataset(year, rows, seed):
+    # rows records in the layout of details-YYYY.csv with distinct event ids
+    rng = random.Random(seed)
+    event_ids = rng.sample(range(100000, 100000 + 20 * rows), rows)
+    records = [f'{event_id},"{rng.choice(STATES)}",{year},"{rng.choice(MONTHS)}","{rng.choice(EVENT_TYPES)}",'
+               f'"C","COUNTY{rng.randrange(100)}",{rng.randrange(3)},0,{rng.randrange(2)},0,"{rng.randrange(100)}.00K","0.00K",""'
+               for event_id in event_ids]
+    table_size = dataset_cache.next_prime_after(2 * rows)
+    return dataset_cache.Dataset(year, records, table_size, [event_id % table_size for event_id in event_ids])
+
+def message_type(payload):
+    if framing.is_frame(payload):
+        type_name = framing.TYPE_NAMES.get(framing.read_header(payload)[0])
+        if type_name != 'message':
+            return type_name
+    message = framing.decode_datagram(payload)
+    # manager replies without a command-type are counted by status, e.g. 'failure'
+    return message.get('command') or message.get('command-type') or message.get('status', 'unknown').lower()
+
+class Simulator:
+    def __init__(self, args, dataset):
+        self.args = args
+        self.dataset = dataset
+        self.clock = SimClock()
+        self.recorder = Recorder(self.clock)
+        self.events = [] # heap of (time, sequence, action, args)
+        self.sequence = itertools.count()
+        self.processed = 0
+        self.nodes = []
+        self.by_addr = {}
+        self.current = None         #node whose globals are in peer.py, None for the manager
+        self.send_at = 0.0          #when what is being sent now leaves, after the sender's service time
+        self.messages = Counter()   #type: messages sent
+        self.datagrams = 0
+        self.bytes = 0
+        self.lost = Counter()       #type: messages lost on the network
+        self.undelivered = Counter() #type: messages sent to a crashed node
+        self.queue_wait = 0.0       #longest a message waited for a busy node
+        self.completed = {}         #'setup' / 'teardown': time the manager heard it was done
+        self.phases = []
+        self.timers_started = False
+        total = args.nodes + args.clients
+        self.manager = manager.Manager(MANAGER_ADDR[0], MANAGER_ADDR[1],
+                                       manager.PortManager(PORT_BASE, PORT_BASE + 2 * total - 1), bind=False)
+        self.manager_busy_until = 0.0
+        self.install()
+
+    def install(self):
+        # point peer.py and manager.py at the simulation
+        peer.time = self.clock
+        manager.time = self.clock
+        peer.send_raw = self.send
+        peer.trace_log = self.recorder
+        peer.pipeline_started = True
+        peer.manager_address, peer.manager_port = MANAGER_ADDR
+        peer.BROADCAST_FANOUT = self.args.fanout
+        dataset_cache.get = lambda year, ring_size=None: self.dataset
+
+    def node_state(self, name, addr):
+        # a fresh copy of peer.py's per node globals
+        return {'registered': False, 'name': name, 'identifier': -1, 'ring_size': -1,
+                'local_table': [], 'local_index': {}, 'replica_index': {}, 'replication_factor': 0,
+                'table_size': 0, 'three_tuple_data': [], 'right_neighbour_tuple': (0, 0, 0),
+                'year_used': self.dataset.year, 'dht_name': peer.DEFAULT_DHT,
+                'leaving': False, 'joining': False, 'tearing_down': False, 'global_table': [],
+                'reassembler': framing.Reassembler(), 'store_compression': {'codec': 'none', 'level': 6},
+                'use_bulk_tcp': False, 'parallel_ingest': False, 'ingest_pending': set(),
+                'ingest_done': threading.Event(), 'broadcasts': {}, 'bloom_filters': {},
+                'bloom_collect': None, 'dataset_rows': 0, 'stale_filters': set(), 'filter_counts': None,
+                'trace_sample': 1.0,
+                'dead_members': set(), 'last_neighbour_ack': 0.0, 'queries_handled': 0,
+                'pending_queries': {}, 'peer_socket': VirtualSocket(self, addr)}
+
+    def add_node(self, client=False):
+        # clients sweep their pending queries like query_sweeper does
+        index = len(self.nodes)
+        addr = ('127.0.0.1', PORT_BASE + 2 * index + 1)
+        node = Node(index, node_name(index), addr, PORT_BASE + 2 * index, self.node_state(node_name(index), addr))
+        node.client = client
+        self.nodes.append(node)
+        self.by_addr[addr] = node
+        if self.timers_started:
+            self.start_node_timers(node)
+        return node
+
+    # event loop
+
+    def schedule(self, when, action, *args):
+        heapq.heappush(self.events, (when, next(self.sequence), action, args))
+
+    def every(self, interval, action, *args):
+        # action(*args) every interval seconds from a random phase, until it returns False
+        def tick():
+            if action(*args) is not False:
+                self.schedule(self.clock.now + interval, tick)
+        self.schedule(self.clock.now + random.uniform(0, interval), tick)
+
+    def run(self, until=None, stop=None):
+        # process events in time order until there are none left, until the given time or until
+        # stop() is true. Returns whether stop() became true
+        while self.events:
+            when, _, action, args = self.events[0]
+            if until is not None and when > until:
+                break
+            heapq.heappop(self.events)
+            self.clock.now = when
+            action(*args)
+            self.processed += 1
+            if stop is not None and stop():
+                return True
+        if until is not None:
+            self.clock.now = max(self.clock.now, until)
+        return False
+
+    # nodes
+
+    def enter(self, node):
+        vars(peer).update(node.state)
+        self.current = node
+
+    def leave(self, node):
+        namespace = vars(peer)
+        node.state = {key: namespace[key] for key in node.state}
+        self.current = None
+
+    def drain(self):
+        # what the dispatcher and the workers would do with everything the node queued
+        peer.release_work()
+        while not peer.inbound_queue.empty() or not peer.work_queue.empty():
+            while not peer.inbound_queue.empty():
+                peer.dispatch(*peer.inbound_queue.get_nowait())
+            while not peer.work_queue.empty():
+                peer.run_job(*peer.work_queue.get_nowait())
+
+    def call(self, node, function, *args):
+        # run function on node now, e.g. a CLI command or a timer
+        if not node.alive:
+            return False
+        self.send_at = self.clock.now
+        self.enter(node)
+        try:
+            result = function(*args)
+            self.drain()
+        finally:
+            self.leave(node)
+        return result
+
+    def deliver(self, node, payload, source, finish):
+        if not node.alive:
+            self.undelivered[message_type(payload)] += 1
+            return
+        self.send_at = finish
+        node.handled += 1
+        self.enter(node)
+        try:
+            peer.accept_frame(memoryview(bytearray(payload)), source)
+            self.drain()
+        finally:
+            self.leave(node)
+
+    def serve(self, payload, source, finish):
+        # the manager's serving loop for one request
+        self.send_at = finish
+        try:
+            message = framing.decode_datagram(payload)
+        except ValueError:
+            return
+        try:
+            response = self.manager.handle_message(message)
+        except Exception as e:
+            response = {'status': 'FAILURE', 'message': str(e)}
+        if 'request-id' in message:
+            response['request-id'] = message['request-id']
+        if response.get('status') == 'SUCCESS' and response.get('command-type') == 'dht-complete':
+            self.completed['setup'] = self.clock.now
+        if response.get('status') == 'SUCCESS' and response.get('command-type') == 'teardown-complete':
+            self.completed['teardown'] = self.clock.now
+        self.send(json.dumps(response).encode(), source)
+
+    # network
+
+    def send(self, payload, addr):
+        payload = bytes(payload)
+        source = self.current.addr if self.current is not None else MANAGER_ADDR
+        kind = message_type(payload)
+        datagrams = len(framing.split(payload))
+        self.messages[kind] += 1
+        self.datagrams += datagrams
+        self.bytes += len(payload)
+        if self.args.loss and random.random() > (1.0 - self.args.loss) ** datagrams:
+            self.lost[kind] += 1
+            return
+        delay = self.args.latency + random.uniform(0, self.args.jitter)
+        if random.random() < self.args.reorder:
+            delay += self.args.reorder_delay
+        self.schedule(self.send_at + delay, self.arrive, payload, source, addr)
+
+    def arrive(self, payload, source, addr):
+        # queue behind whatever the receiver is still busy with
+        now = self.clock.now
+        if addr == MANAGER_ADDR:
+            start = max(now, self.manager_busy_until)
+            self.manager_busy_until = start + self.args.manager_service_time
+            action, target, finish = self.serve, None, self.manager_busy_until
+        else:
+            node = self.by_addr.get(addr)
+            if node is None:
+                self.undelivered[message_type(payload)] += 1
+                return
+            start = max(now, node.busy_until)
+            node.busy_until = start + self.args.service_time
+            action, target, finish = self.deliver, node, node.busy_until
+        self.queue_wait = max(self.queue_wait, start - now)
+        args = (payload, source, finish) if target is None else (target, payload, source, finish)
+        if start > now:
+            self.schedule(start, action, *args)
+        else:
+            action(*args)
+
+    # scenario
+
+    def begin_phase(self, label):
+        return {'label': label, 'start': self.clock.now, 'messages': Counter(self.messages),
+                'datagrams': self.datagrams, 'bytes': self.bytes, 'lost': sum(self.lost.values()),
+                'traces': set(self.recorder.traces)}
+
+    def end_phase(self, phase, completed=True, end=None):
+        phase['end'] = self.clock.now if end is None else end
+        phase['completed'] = completed
+        phase['messages'] = self.messages - phase['messages']
+        phase['datagrams'] = self.datagrams - phase['datagrams']
+        phase['bytes'] = self.bytes - phase['bytes']
+        phase['lost'] = sum(self.lost.values()) - phase['lost']
+        phase['traces'] = [entry for trace_id, entry in self.recorder.traces.items() if trace_id not in phase['traces']]
+        self.phases.append(phase)
+
+    def register(self, nodes):
+        # register is sent once, nodes that got no answer try again
+        for _ in range(REGISTER_ATTEMPTS):
+            missing = [node for node in nodes if not node.state['registered']]
+            if not missing:
+                break
+            for node in missing:
+                self.call(node, peer.register, node.name, node.addr[0], node.m_port, node.addr[1])
+            self.run(until=self.clock.now + REGISTER_TIMEOUT,
+                     stop=lambda: all(node.state['registered'] for node in missing))
+        return [node for node in nodes if node.name in self.manager.peers]
+
+    def start_timers(self):
+        self.timers_started = True
+        # without heartbeats the manager would see every member go quiet and mark it dead
+        if self.args.heartbeats:
+            self.every(manager.HEALTH_CHECK_INTERVAL, self.manager.check_health)
+        for node in self.nodes:
+            self.start_node_timers(node)
+
+    def start_node_timers(self, node):
+        if self.args.heartbeats:
+            self.every(peer.HEARTBEAT_INTERVAL, self.call, node, peer.heartbeat_tick)
+        if node.client:
+            self.every(QUERY_SWEEP_INTERVAL, self.call, node, peer.sweep_queries)
+
+    def setup(self, ring):
+        leader = ring[0]
+        phase = self.begin_phase(f"setup-dht ({len(ring)} members)")
+        self.call(leader, peer.dht_setup, leader.name, len(ring), self.dataset.year, peer.DEFAULT_DHT,
+                  self.args.replicas, self.args.codec)
+        done = self.run(until=self.clock.now + self.args.timeout, stop=lambda: 'setup' in self.completed)
+        # dht-complete goes out once the leader has sent its batches, not when they have landed.
+        # Give the last one time to go all the way round the ring
+        hop = self.args.latency + self.args.jitter + self.args.service_time + self.args.reorder_delay * (self.args.reorder > 0)
+        self.run(until=self.clock.now + hop * len(ring) * (self.args.replicas + 1) + 1.0)
+        # and for the leader to share the bloom filters
+        self.run(until=self.clock.now + self.args.timeout,
+                 stop=lambda: leader.state['bloom_collect'] is None and not leader.state['broadcasts'])
+        self.end_phase(phase, done, self.completed.get('setup'))
+        phase['stored'] = sum(len(node.state['local_table']) for node in ring)
+        phase['replicas'] = sum(len(node.state['replica_index']) for node in ring)
+        return ring
+
+    def query(self, label, clients):
+        phase = self.begin_phase(label)
+        start = self.clock.now
+        event_ids = [dataset_cache.line_event_id(line)
+                     for line in random.choices(self.dataset.records, k=self.args.queries)]
+        if self.args.missing:
+            # ids that are in no record
+            known = set(dataset_cache.line_event_id(line) for line in self.dataset.records)
+            unknown = [event_id for event_id in range(1, 2 * len(known) + 2) if event_id not in known]
+            event_ids = [random.choice(unknown) if random.random() < self.args.missing else event_id
+                         for event_id in event_ids]
+        issued = []
+        for i, event_id in enumerate(event_ids):
+            self.schedule(start + i / self.args.query_rate, self.issue, label, random.choice(clients), event_id, issued)
+        finished = False
+
+        def check():
+            # every query answered or given up on
+            nonlocal finished
+            finished = len(issued) == len(event_ids) and all(q['query']['done'].is_set() for q in issued)
+            return not finished
+        self.every(QUERY_CHECK_INTERVAL, check)
+        done = self.run(until=start + len(event_ids) / self.args.query_rate + self.args.timeout,
+                        stop=lambda: finished)
+        self.end_phase(phase, done)
+        phase['queries'] = issued
+
+    def issue(self, label, client, event_id, issued):
+        request_ids = self.call(client, peer.query_dht, client.name, [event_id])
+        if request_ids:
+            issued.append({'issued': self.clock.now, 'query': client.state['pending_queries'][request_ids[0]]})
+
+    def churn(self, ring, count):
+        # crash count members other than the leader, nothing is said to anyone
+        victims = random.sample(ring[1:], min(count, len(ring) - 1))
+        for node in victims:
+            node.alive = False
+        return victims
+
+    def top_k(self, client, field, k, threshold_passing):
+        phase = self.begin_phase(f"top-k {field} k={k}" + (" threshold passing" if threshold_passing else ""))
+        issued = self.clock.now
+        request_id = self.call(client, peer.top_k, client.name, field, k, threshold_passing)
+        query = client.state['pending_queries'][request_id]
+        done = self.run(until=self.clock.now + self.args.timeout, stop=lambda: query['done'].is_set())
+        self.end_phase(phase, done)
+        # what the whole dataset says, ties may pick other records with the same values
+        values = sorted((peer.field_value(dataset_cache.parse_line(line), field) for line in self.dataset.records), reverse=True)
+        phase['top-k'] = {'result': query['result'], 'expected': values[:k], 'ms': (self.clock.now - issued) * 1000.0}
+
+    def teardown(self, leader):
+        phase = self.begin_phase('teardown-dht')
+        self.call(leader, peer.teardown_dht)
+        done = self.run(until=self.clock.now + self.args.timeout, stop=lambda: 'teardown' in self.completed)
+        self.end_phase(phase, done)
+
+def spread(values):
+    values = sorted(values)
+    if not values:
+        return "-"
+    return (f"mean {sum(values) / len(values):.2f}  p50 {loadgen.percentile(values, 50):.2f}  "
+            f"p99 {loadgen.percentile(values, 99):.2f}  max {values[-1]:.2f}")
+
+def spread_ms(values):
+    return spread([value * 1000.0 for value in values])
+
+def report(sim, out):
+    print(f"{len(sim.nodes)} nodes, {sim.processed} events, simulated {sim.clock.now:.3f}s", file=out)
+    for phase in sim.phases:
+        duration = phase['end'] - phase['start']
+        print(f"\n{phase['label']}: {'done' if phase['completed'] else 'NOT DONE'} in {duration * 1000.0:.1f} ms", file=out)
+        print(f"  messages {sum(phase['messages'].values())}  datagrams {phase['datagrams']}  "
+              f"bytes {phase['bytes']}  lost {phase['lost']}", file=out)
+        print("  by type: " + ", ".join(f"{kind} {count}" for kind, count in phase['messages'].most_common()), file=out)
+        if 'stored' in phase:
+            print(f"  records stored {phase['stored']} of {len(sim.dataset.records)}, replicas {phase['replicas']}", file=out)
+        by_type = {}
+        for entry in phase['traces']:
+            by_type.setdefault(entry['type'], []).append(entry)
+        for kind, entries in sorted(by_type.items(), key=lambda item: str(item[0])):
+            if kind in ('find-event', None):
+                continue
+            expired = sum(entry['expired'] for entry in entries)
+            print(f"  {kind} x{len(entries)}: messages {spread([e['messages'] for e in entries])}", file=out)
+            if expired or any(e['forwards'] for e in entries):
+                print(f"    hops forwarded {spread([e['forwards'] for e in entries])}"
+                      + (f"  ttl expired {expired}" if expired else ""), file=out)
+            print(f"    ms to last message {spread_ms([e['last'] - e['start'] for e in entries])}", file=out)
+        if 'queries' in phase:
+            report_queries(sim, phase['queries'], out)
+        if 'top-k' in phase:
+            result = phase['top-k']['result']
+            if result is None:
+                print("  no answer", file=out)
+            else:
+                values = [entry[0] for entry in result['records']]
+                print(f"  {result['candidates']} candidates from {result['members']} members, "
+                      f"{'matches' if values == phase['top-k']['expected'] else 'DIFFERS FROM'} the dataset's top {len(values)}", file=out)
+    lost = sum(sim.lost.values())
+    print(f"\nnetwork: {sum(sim.messages.values())} messages, {sim.datagrams} datagrams, {lost} lost, "
+          f"{sum(sim.undelivered.values())} to crashed nodes, longest queue wait {sim.queue_wait * 1000.0:.3f} ms", file=out)
+    busiest = sorted(sim.nodes, key=lambda node: node.handled, reverse=True)[:5]
+    print("busiest nodes: " + ", ".join(f"{node.name} {node.handled}" for node in busiest), file=out)
+
+def report_queries(sim, issued, out):
+    answered = [q for q in issued if q['query']['result'] is not None]
+    found = [q for q in answered if q['query']['result'].get('found')]
+    traces = [sim.recorder.traces.get(q['query']['trace']) for q in answered]
+    latencies = [trace['done'] - q['issued'] for q, trace in zip(answered, traces) if trace and trace['done'] is not None]
+    retried = sum(1 for q in issued if q['query']['attempt'] > 0)
+    print(f"  queries {len(issued)}: answered {len(answered)}, found {len(found)}, retried {retried}, "
+          f"failed {len(issued) - len(answered)}", file=out)
+    print(f"    hops {spread([len(q['query']['result'].get('id-seq', [])) for q in answered])}", file=out)
+    # the peer messages of the trace plus a manager round trip per attempt
+    print(f"    messages {spread([t['messages'] + 2 * (q['query']['attempt'] + 1) for q, t in zip(answered, traces) if t])}", file=out)
+    print(f"    latency ms {spread_ms(latencies)}", file=out)
+
+def main():
+    parser = argparse.ArgumentParser(description='Discrete event simulation of the DHT protocol')
+    parser.add_argument('--nodes', type=int, default=100, help='DHT members')
+    parser.add_argument('--clients', type=int, default=10, help='peers outside the DHT that send the queries')
+    parser.add_argument('--rows', type=int, default=10000, help='records in the synthetic dataset')
+    parser.add_argument('--year', type=int, help='use ./CSVFiles/details-YEAR.csv instead of synthetic records')
+    parser.add_argument('--replicas', type=int, default=0)
+    parser.add_argument('--codec', choices=['none', 'zlib', 'lzma'], default='none')
+    parser.add_argument('--fanout', type=int, default=peer.BROADCAST_FANOUT, help='broadcast tree fanout')
+    parser.add_argument('--queries', type=int, default=1000, help='lookups per query phase')
+    parser.add_argument('--missing', type=float, default=0.0, help='share of lookups for ids in no record')
+    parser.add_argument('--query-rate', type=float, default=500.0, help='lookups per simulated second')
+    parser.add_argument('--top-k', type=int, default=0, help='also run top-k queries over every field for this k')
+    parser.add_argument('--churn', type=int, default=0, help='members to crash before the second query phase')
+    parser.add_argument('--latency', type=float, default=0.001, help='one way network latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0005, help='extra random latency up to this')
+    parser.add_argument('--loss', type=float, default=0.0, help='datagram loss probability')
+    parser.add_argument('--reorder', type=float, default=0.0, help='share of messages held back by --reorder-delay')
+    parser.add_argument('--reorder-delay', type=float, default=0.01)
+    parser.add_argument('--service-time', type=float, default=0.0001, help='seconds a node spends per message')
+    parser.add_argument('--manager-service-time', type=float, default=0.0001)
+    parser.add_argument('--no-heartbeats', dest='heartbeats', action='store_false',
+                        help='no heartbeats: faster, but crashes and lost broadcast acks go unnoticed')
+    parser.add_argument('--timeout', type=float, default=60.0, help='simulated seconds a phase may take')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help="show the peers' and the manager's output")
+    args = parser.parse_args()
+    if args.nodes < 3:
+        parser.error('setup-dht needs at least 3 nodes')
+
+    if args.year is not None and not os.path.exists(dataset_cache.csv_path(args.year)):
+        parser.error(f"no {dataset_cache.csv_path(args.year)}")
+
+    random.seed(args.seed)
+    if args.year is not None:
+        dataset = dataset_cache.get(args.year, args.nodes)
+    else:
+        dataset = synthetic_dataset(1950, args.rows, args.seed)
+    sim = Simulator(args, dataset)
+    out = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        # clients register after setup-dht, which would otherwise pick some of them as members
+        phase = sim.begin_phase('register')
+        ring = sim.register([sim.add_node() for _ in range(args.nodes)])
+        sim.end_phase(phase)
+        sim.start_timers()
+        ring = sim.setup(ring)
+        phase = sim.begin_phase('register clients')
+        clients = sim.register([sim.add_node(client=True) for _ in range(args.clients)])
+        sim.end_phase(phase)
+        if not clients:
+            print("no client registered", file=out)
+            return
+        sim.query('queries', clients)
+        if args.top_k:
+            for field in peer.TOP_K_FIELDS:
+                for threshold_passing in (False, True):
+                    sim.top_k(clients[0], field, args.top_k, threshold_passing)
+        if args.churn:
+            victims = sim.churn(ring, args.churn)
+            print(f"crashed {len(victims)} members at {sim.clock.now:.3f}s", file=out)
+            sim.query(f"queries after {len(victims)} crashes", clients)
+        sim.teardown(ring[0])
+    finally:
+        if sys.stdout is not out:
+            sys.stdout.close()
+            sys.stdout = out
+    report(sim, out)
+
+if __name__ == "__main__":
+    main()
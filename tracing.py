@@ -0,0 +1,113 @@
+# tracing of messages across hops
+# a traced message carries a trace id in its frame header (framing.FLAG_TRACE). Every peer that
+# sees a traced frame, forwarding it blind or handling it, appends what happened to its own trace
+# file ./traces/<peer_name>.jsonl, one JSON object per line:
+#   {'trace', 't', 'name', 'node', 'event', 'type', ...}
+# events: start (the originator began the operation), recv (frame came off the socket),
+# forward (routed on from the header only), dispatch (decoded and handled, with the time it
+# waited in the inbound queue), work (ran on the worker pool, with the time it waited for a
+# worker), send (a message went out as part of the trace), done (the originator got its answer)
+#
+# whatever a peer sends while handling a traced message is traced too: the trace id follows the
+# handling thread (current_trace) and send_message puts it on every frame it builds
+#
+# merge the files from all peers into per request timelines (times are wall clock, so this
+# assumes the peers' clocks agree, e.g. all on one host):
+#   python tracing.py traces/
+#   python tracing.py traces/*.jsonl --slowest 5
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+
+TRACE_DIRECTORY = './traces'
+
+current = threading.local()
+
+def current_trace():
+    return getattr(current, 'trace_id', None)
+
+def set_current(trace_id):
+    current.trace_id = trace_id
+
+def sample(rate):
+    # a new trace id for rate of the calls, None for the rest
+    if rate > 0 and random.random() < rate:
+        return random.getrandbits(63)
+    return None
+
+class TraceLog:
+# the trace file of one peer, opened on first use
+    def __init__(self, directory=TRACE_DIRECTORY):
+        self.directory = directory
+        self.file = None
+        self.lock = threading.Lock()
+
+    def record(self, trace_id, name, node, event, **fields):
+        entry = {'trace': trace_id, 't': time.time(), 'name': name, 'node': node, 'event': event}
+        entry.update(fields)
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            if self.file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.file = open(os.path.join(self.directory, f"{name or os.getpid()}.jsonl"), 'a')
+            self.file.write(line)
+            self.file.flush()
+
+def read_traces(paths):
+    # trace id: events sorted by time, from trace files or directories of them
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.jsonl')]
+        else:
+            files.append(path)
+    traces = {}
+    for path in files:
+        with open(path) as file:
+            for line in file:
+                line = line.strip()
+                if line:
+                    entry = json.loads(line)
+                    traces.setdefault(entry['trace'], []).append(entry)
+    for events in traces.values():
+        events.sort(key=lambda entry: entry['t'])
+    return traces
+
+def print_timeline(trace_id, events):
+    start = events[0]['t']
+    nodes = sorted({entry['name'] for entry in events})
+    print(f"trace {trace_id:x}: {(events[-1]['t'] - start) * 1000.0:.3f} ms, {len(events)} events on {len(nodes)} peers ({', '.join(nodes)})")
+    previous = start
+    for entry in events:
+        details = {k: v for k, v in entry.items() if k not in ('trace', 't', 'name', 'node', 'event', 'type')}
+        extra = ' '.join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}" for k, v in details.items())
+        print(f"  +{(entry['t'] - start) * 1000.0:9.3f} ms  (+{(entry['t'] - previous) * 1000.0:8.3f})  "
+              f"{entry['name']:>10}[{entry['node']}]  {entry['event']:<8} {entry.get('type', ''):<18} {extra}")
+        previous = entry['t']
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge per peer trace files into per request timelines')
+    parser.add_argument('paths', nargs='*', default=[TRACE_DIRECTORY], help='trace files or directories')
+    parser.add_argument('--trace', help='only this trace id (hex)')
+    parser.add_argument('--slowest', type=int, default=0, help='only the N longest traces')
+    args = parser.parse_args()
+    traces = read_traces(args.paths)
+    if args.trace:
+        wanted = int(args.trace, 16)
+        traces = {t: events for t, events in traces.items() if t == wanted}
+    order = sorted(traces, key=lambda t: traces[t][0]['t'])
+    if args.slowest:
+        order = sorted(traces, key=lambda t: traces[t][-1]['t'] - traces[t][0]['t'], reverse=True)[:args.slowest]
+    if not order:
+        print("no traces found", file=sys.stderr)
+    for trace_id in order:
+        print_timeline(trace_id, traces[trace_id])
+        print()
+
+if __name__ == "__main__":
+    main()